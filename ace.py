@@ -3,21 +3,41 @@ import json
 import logging.handlers
 import os
 from datetime import datetime
+from time import perf_counter
 
 import aiohttp
 import asyncpg
 import coloredlogs
 from discord.ext import commands
 
+import config
 from config import *
+from utils.botmetrics import BotMetrics
 from utils.commanderrorlogic import CommandErrorLogic
-from utils.configtable import ConfigTable
+from utils.commandlog import CommandLog
+from utils.configtable import ConfigTable, ConfigTableListener
 from utils.context import AceContext
 from utils.guildconfigrecord import GuildConfigRecord
 from utils.help import EditedMinimalHelpCommand, PaginatedHelpCommand
+from utils.queries import CatalogConnection, catalog
+from utils.querystats import QueryStats
 from utils.string import po
 from utils.time import pretty_seconds
 
+log = logging.getLogger(__name__)
+
+# optional settings, these might not be present in older config files
+PRELOAD_CONFIG = getattr(config, 'PRELOAD_CONFIG', False)
+
+# queries slower than this many seconds are logged
+SLOW_QUERY_THRESHOLD = getattr(config, 'SLOW_QUERY_THRESHOLD', 0.5)
+
+# port for the local prometheus metrics endpoint, None to disable. cluster workers add their worker id
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+
+# how often cluster workers report to the supervisor, in seconds
+STATUS_INTERVAL = 30
+
 EXTENSIONS = (
 	'cogs.fun',
 	'cogs.configuration',
@@ -47,9 +67,10 @@ class AceBot(commands.Bot):
 	aiohttp: aiohttp.ClientSession
 	db: asyncpg.pool
 	config: ConfigTable
+	command_log: CommandLog
 	startup_time: datetime
 
-	def __init__(self, db, **kwargs):
+	def __init__(self, db, query_stats=None, status_queue=None, worker_id=None, **kwargs):
 		super().__init__(
 			command_prefix=self.prefix_resolver,
 			owner_id=OWNER_ID,
@@ -61,13 +82,28 @@ class AceBot(commands.Bot):
 		)
 
 		self.db = db
+		self.query_stats = query_stats
+
+		# set when running as a cluster worker, see cluster.py
+		self.status_queue = status_queue
+		self.worker_id = worker_id
+
 		self.config = ConfigTable(self, table='config', primary='guild_id', record_class=GuildConfigRecord)
+		self.command_log = CommandLog(self)
+
+		# evicts cached ConfigTable entries when another process changes them
+		self.config_listener = ConfigTableListener(self, DB_BIND)
+
+		self.metrics = BotMetrics(self)
 
 		self.ready = asyncio.Event()
 		self.startup_time = datetime.utcnow()
 
 		aiohttp_log = logging.getLogger('aiotrace')
 
+		async def on_request_start(session, ctx, start):
+			ctx.started_at = perf_counter()
+
 		async def on_request_end(session, ctx, end):
 			resp = end.response
 			aiohttp_log.info(
@@ -75,8 +111,15 @@ class AceBot(commands.Bot):
 				str(resp.status), resp.reason, end.method.upper(), end.url, resp.content_type
 			)
 
+			self.metrics.http.labels(end.url.host, str(resp.status)).observe(perf_counter() - ctx.started_at)
+
+		async def on_request_exception(session, ctx, exc):
+			self.metrics.http.labels(exc.url.host, 'error').observe(perf_counter() - ctx.started_at)
+
 		trace_config = aiohttp.TraceConfig()
+		trace_config.on_request_start.append(on_request_start)
 		trace_config.on_request_end.append(on_request_end)
+		trace_config.on_request_exception.append(on_request_exception)
 
 		self.aiohttp = aiohttp.ClientSession(
 			loop=self.loop,
@@ -113,8 +156,17 @@ class AceBot(commands.Bot):
 		if not self.ready.is_set():
 			self.load_extensions()
 
+			# the pool connected before the cogs registered their statements, reconnect so they're prepared up front
+			await self.db.expire_connections()
+
+			if PRELOAD_CONFIG:
+				await self.preload_config_tables()
+
 			self.loop.create_task(self.update_dbl())
 
+			if self.status_queue is not None:
+				self.loop.create_task(self.report_status_loop())
+
 			self.ready.set()
 			log.info('Ready! %s', po(self.user))
 
@@ -146,6 +198,8 @@ class AceBot(commands.Bot):
 		if not perms.send_messages or not perms.read_message_history:
 			return
 
+		ctx.started_at = perf_counter()
+
 		await self.invoke(ctx)
 
 	async def prefix_resolver(self, bot, message):
@@ -155,6 +209,47 @@ class AceBot(commands.Bot):
 		gc = await self.config.get_entry(message.guild.id)
 		return gc.prefix or DEFAULT_PREFIX
 
+	@property
+	def config_tables(self):
+		'''All ConfigTables in use, including the ones owned by cogs.'''
+
+		tables = [self.config]
+
+		for cog in self.cogs.values():
+			table = getattr(cog, 'config', None)
+			if isinstance(table, ConfigTable):
+				tables.append(table)
+
+		return tables
+
+	async def preload_config_tables(self):
+		'''Fill the cache of every ConfigTable, so the first message from each guild doesn't hit the db.'''
+
+		guild_keys = list((guild.id,) for guild in self.guilds)
+
+		total = 0
+		total_elapsed = 0.0
+
+		for table in self.config_tables:
+			# bounded tables only cache what's in use, loading every row would just have them evict each other
+			if table.max_entries is not None:
+				log.debug('Not preloading bounded table %s', table.table)
+				continue
+
+			# only tables keyed by guild alone can tell which keys are missing
+			known_keys = guild_keys if table.primary == ('guild_id',) else None
+
+			try:
+				count, elapsed = await table.preload(known_keys=known_keys)
+			except (asyncpg.PostgresError, OSError) as exc:
+				log.warning('Failed preloading table %s: %s', table.table, str(exc))
+				continue
+
+			total += count
+			total_elapsed += elapsed
+
+		log.info('Preloaded %s config records in %.2fs', total, total_elapsed)
+
 	def load_extensions(self):
 		reloaded = list()
 
@@ -181,13 +276,22 @@ class AceBot(commands.Bot):
 		spl = ctx.message.content.split('\n')
 		log.info('%s in %s: %s', po(ctx.author), po(ctx.guild), spl[0] + (' ...' if len(spl) > 1 else ''))
 
+	async def on_socket_response(self, msg):
+		t = msg['t']
+
+		if t is not None:
+			self.metrics.gateway_events.labels(t).inc()
+
 	async def on_command_completion(self, ctx: AceContext):
-		await ctx.db.execute(
-			'INSERT INTO log (guild_id, channel_id, user_id, timestamp, command) VALUES ($1, $2, $3, $4, $5)',
+		self.metrics.observe_command(ctx, 'ok')
+
+		self.command_log.append(
 			ctx.guild.id, ctx.channel.id, ctx.author.id, datetime.utcnow(), ctx.command.qualified_name
 		)
 
 	async def on_command_error(self, ctx, exc):
+		self.metrics.observe_command(ctx, 'error')
+
 		async with CommandErrorLogic(ctx, exc) as handler:
 			if isinstance(exc, commands.CommandInvokeError):
 				if isinstance(exc.original, discord.HTTPException):
@@ -225,6 +329,26 @@ class AceBot(commands.Bot):
 			elif isinstance(exc, discord.DiscordException):
 				handler.oops()
 
+	async def close(self):
+		# let cogs finish pending discord work while the connection is still up
+		for cog in list(self.cogs.values()):
+			cog_close = getattr(cog, 'cog_close', None)
+
+			if cog_close is not None:
+				try:
+					await cog_close()
+				except Exception:
+					log.exception('Failed closing cog %s', cog.qualified_name)
+
+		await super().close()
+
+		# write out any command log rows still in the buffer
+		await self.command_log.close()
+
+		await self.metrics.close()
+
+		await self.config_listener.close()
+
 	async def on_guild_join(self, guild):
 		log.info('Join guild %s', po(guild))
 		await self.update_dbl()
@@ -245,33 +369,67 @@ class AceBot(commands.Bot):
 	async def update_dbl(self):
 		'''Sends an update on guild count to dbl.'''
 
+		# cluster workers only report their count, the supervisor posts the total
+		if self.status_queue is not None:
+			self.report_status()
+			return
+
 		if DBL_KEY is None:
 			return
 
 		if not self.is_ready():
 			await self.wait_until_ready()
 
-		url = 'https://discordbots.org/api/bots/{}/stats'.format(self.user.id)
+		await post_dbl(self.aiohttp, self.user.id, len(self.guilds))
+
+	def report_status(self):
+		'''Send this workers health and guild count to the cluster supervisor.'''
+
+		self.status_queue.put_nowait(dict(
+			worker_id=self.worker_id,
+			user_id=self.user.id if self.user else None,
+			shard_ids=list(self.shard_ids or ()),
+			ready=self.is_ready(),
+			closed=self.is_closed(),
+			guilds=len(self.guilds),
+			latency=self.latency,
+		))
+
+	async def report_status_loop(self):
+		while not self.is_closed():
+			self.report_status()
+			await asyncio.sleep(STATUS_INTERVAL)
+
+
+class ShardedAceBot(AceBot, commands.AutoShardedBot):
+	'''AceBot running a specific set of shards, used by cluster workers.'''
+
+	pass
+
 
-		server_count = len(self.guilds)
-		data = dict(server_count=server_count)
+async def post_dbl(session, user_id, server_count, shard_count=None):
+	url = 'https://discordbots.org/api/bots/{}/stats'.format(user_id)
 
-		headers = {
-			'Content-Type': 'application/json',
-			'Authorization': DBL_KEY
-		}
+	data = dict(server_count=server_count)
+	if shard_count is not None:
+		data['shard_count'] = shard_count
 
-		async with self.aiohttp.post(url, data=json.dumps(data), headers=headers) as resp:
-			if resp.status == 200:
-				log.info('Updated DBL with server count %s', server_count)
-			else:
-				log.info('Failed updating DBL: %s - %s', resp.reason, await resp.text())
+	headers = {
+		'Content-Type': 'application/json',
+		'Authorization': DBL_KEY
+	}
 
+	async with session.post(url, data=json.dumps(data), headers=headers) as resp:
+		if resp.status == 200:
+			log.info('Updated DBL with server count %s', server_count)
+		else:
+			log.info('Failed updating DBL: %s - %s', resp.reason, await resp.text())
 
-def setup_logger():
+
+def setup_logger(file_name='logs/log.log'):
 	# init first log file
-	if not os.path.isfile('logs/log.log'):
-		open('logs/log.log', 'w+')
+	if not os.path.isfile(file_name):
+		open(file_name, 'w+')
 
 	# set logging levels for various libs
 	logging.getLogger('discord').setLevel(logging.INFO)
@@ -290,7 +448,7 @@ def setup_logger():
 
 	)
 
-	file = logging.handlers.TimedRotatingFileHandler('logs/log.log', when='midnight', encoding='utf-8-sig')
+	file = logging.handlers.TimedRotatingFileHandler(file_name, when='midnight', encoding='utf-8-sig')
 	file.setFormatter(fmt)
 	file.setLevel(logging.INFO)
 
@@ -302,7 +460,7 @@ def setup_logger():
 	return logging.getLogger(__name__)
 
 
-async def setup():
+async def setup(shard_ids=None, shard_count=None, status_queue=None, worker_id=None):
 	# create folders
 	for path in ('data', 'logs', 'error', 'feedback', 'ahk_eval'):
 		if not os.path.exists(path):
@@ -317,31 +475,59 @@ async def setup():
 
 	discord.Embed = Embed
 
-	def patched_execute(old):
-		async def new(self, query, args, limit, timeout, return_status=False):
-			log.debug(query)
-			return await old(self, query, args, limit, timeout, return_status)
-
-		return new
-
-	asyncpg.Connection._execute = patched_execute(asyncpg.Connection._execute)
+	# per-query latency stats
+	query_stats = QueryStats(slow_threshold=SLOW_QUERY_THRESHOLD)
+	query_stats.install()
 
 	# connect to db
 	log.info('Creating postgres pool')
-	db = await asyncpg.create_pool(DB_BIND)
+	# statements in the query catalog are prepared on each new connection
+	db = await asyncpg.create_pool(
+		DB_BIND, init=catalog.init_connection, connection_class=CatalogConnection
+	)
 
 	# create allowed mentions
 	allowed_mentions = discord.AllowedMentions(everyone=False, users=True, roles=False, replied_user=True)
 
 	# init bot
 	log.info('Initializing bot')
-	bot = AceBot(db=db, loop=loop, intents=BOT_INTENTS, allowed_mentions=allowed_mentions)
+
+	if shard_ids is None:
+		bot = AceBot(
+			db=db, query_stats=query_stats, loop=loop, intents=BOT_INTENTS, allowed_mentions=allowed_mentions
+		)
+	else:
+		log.info('Running shards %s of %s', ', '.join(str(shard_id) for shard_id in shard_ids), shard_count)
+		bot = ShardedAceBot(
+			db=db, query_stats=query_stats, loop=loop, intents=BOT_INTENTS, allowed_mentions=allowed_mentions,
+			shard_ids=shard_ids, shard_count=shard_count, status_queue=status_queue, worker_id=worker_id
+		)
+
+	if METRICS_PORT is not None:
+		await bot.metrics.start('127.0.0.1', METRICS_PORT + (worker_id or 0))
 
 	# start it
 	log.info('Logging in and starting bot')
 	await bot.start(BOT_TOKEN)
 
 
+def run_worker(worker_id, shard_ids, shard_count, status_queue, main=None):
+	'''Entry point for cluster worker processes. `main` replaces `setup`, for `cluster.py --check`.'''
+
+	global log, loop
+
+	# start from a clean slate in case the process was forked from the supervisor
+	logging.getLogger().handlers.clear()
+
+	log = setup_logger('logs/worker-{0}.log'.format(worker_id))
+
+	# never reuse an inherited loop, the supervisor's is running
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	loop.run_until_complete((main or setup)(shard_ids, shard_count, status_queue, worker_id))
+
+
 if __name__ == '__main__':
 	log = setup_logger()
 	loop = asyncio.get_event_loop()
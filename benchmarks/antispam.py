@@ -0,0 +1,156 @@
+'''Anti-spam checks in Moderation.on_message, replayed over many guilds.
+
+Replays `messages` messages from `members` members spread over `guilds` guilds, arriving at
+`rate` messages per second of simulated time, through the spam and mention checks. Runs them
+once the old way, with discord.py CooldownMappings behind global locks, and once with the
+RateLimiter each guild config now holds. Every message is its own task, like gateway events.
+
+Reports throughput, how many members got rate limited, and how many buckets are held at the
+end, before and after a sweep.
+
+	python -m benchmarks.antispam [guilds] [members] [messages] [rate]
+'''
+
+import asyncio
+import random
+import sys
+from time import perf_counter
+from types import SimpleNamespace
+
+from discord.ext import commands
+
+from utils.ratelimit import RateLimiter
+
+SPAM_COUNT, SPAM_PER = 8, 10
+MENTION_COUNT, MENTION_PER = 8, 16
+
+# one in this many members spams, the rest chat normally
+SPAMMER_RATIO = 50
+
+
+def make_messages(guilds, members, messages, rate):
+	guild_objs = [SimpleNamespace(id=idx) for idx in range(guilds)]
+	member_objs = [SimpleNamespace(id=idx, guild=guild_objs[idx % guilds]) for idx in range(members)]
+
+	# spammers are picked a lot more often than everyone else
+	weights = [SPAMMER_RATIO if idx % SPAMMER_RATIO == 0 else 1 for idx in range(members)]
+	authors = random.choices(member_objs, weights=weights, k=messages)
+
+	replay = list()
+
+	for idx, author in enumerate(authors):
+		mentions = [None] * random.choice((0, 0, 0, 0, 1, 2, 5))
+		message = SimpleNamespace(guild=author.guild, author=author, mentions=mentions)
+		# discord.py cooldowns treat a time of 0 as no time given
+		replay.append((1 + idx / rate, message))
+
+	return replay
+
+
+async def run_locked(replay, guilds):
+	spam_lock = asyncio.Lock()
+	mention_lock = asyncio.Lock()
+
+	spam = {
+		idx: commands.CooldownMapping.from_cooldown(SPAM_COUNT, SPAM_PER, commands.BucketType.member)
+		for idx in range(guilds)
+	}
+	mention = {
+		idx: commands.CooldownMapping.from_cooldown(MENTION_COUNT, MENTION_PER, commands.BucketType.member)
+		for idx in range(guilds)
+	}
+
+	limited = set()
+
+	async def on_message(now, message):
+		spam_cooldown = spam[message.guild.id]
+		mention_cooldown = mention[message.guild.id]
+
+		async with spam_lock:
+			res = spam_cooldown.update_rate_limit(message, now)
+			if res is not None:
+				spam_cooldown._cache[spam_cooldown._bucket_key(message)].reset()
+
+		if res is not None:
+			limited.add(message.author.id)
+
+		if message.mentions:
+			async with mention_lock:
+				for _ in message.mentions:
+					res = mention_cooldown.update_rate_limit(message, now)
+					if res is not None:
+						mention_cooldown._cache[mention_cooldown._bucket_key(message)].reset()
+						break
+
+			if res is not None:
+				limited.add(message.author.id)
+
+	start = perf_counter()
+	await asyncio.gather(*(on_message(now, message) for now, message in replay))
+	elapsed = perf_counter() - start
+
+	mappings = list(spam.values()) + list(mention.values())
+	buckets = sum(len(mapping._cache) for mapping in mappings)
+
+	return elapsed, len(limited), buckets, None
+
+
+async def run_limiter(replay, guilds):
+	spam = {idx: RateLimiter(SPAM_COUNT, SPAM_PER) for idx in range(guilds)}
+	mention = {idx: RateLimiter(MENTION_COUNT, MENTION_PER) for idx in range(guilds)}
+
+	limited = set()
+
+	async def on_message(now, message):
+		key = message.author.id
+
+		res = spam[message.guild.id].hit(key, now=now)
+
+		if res is not None:
+			spam[message.guild.id].reset(key)
+			limited.add(key)
+
+		if message.mentions:
+			res = mention[message.guild.id].hit(key, cost=len(message.mentions), now=now)
+
+			if res is not None:
+				mention[message.guild.id].reset(key)
+				limited.add(key)
+
+	start = perf_counter()
+	await asyncio.gather(*(on_message(now, message) for now, message in replay))
+	elapsed = perf_counter() - start
+
+	limiters = list(spam.values()) + list(mention.values())
+	buckets = sum(len(limiter) for limiter in limiters)
+
+	end = replay[-1][0]
+	for limiter in limiters:
+		limiter.sweep(now=end)
+
+	return elapsed, len(limited), buckets, sum(len(limiter) for limiter in limiters)
+
+
+async def run(guilds, members, messages, rate):
+	replay = make_messages(guilds, members, messages, rate)
+
+	print('Replaying {0:,} messages from {1:,} members in {2:,} guilds at {3:,} msg/s'.format(
+		messages, members, guilds, rate
+	))
+
+	for name, runner in (('locks', run_locked), ('limiter', run_limiter)):
+		elapsed, limited, buckets, swept = await runner(replay, guilds)
+
+		print('{0}: {1:,.0f} msg/s, {2:,} members limited, {3:,} buckets{4}'.format(
+			name, messages / elapsed, limited, buckets,
+			'' if swept is None else ' ({0:,} after sweep)'.format(swept)
+		))
+
+
+if __name__ == '__main__':
+	guilds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	members = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+	messages = int(sys.argv[3]) if len(sys.argv) > 3 else 200000
+	rate = int(sys.argv[4]) if len(sys.argv) > 4 else 2000
+
+	asyncio.get_event_loop().run_until_complete(run(guilds, members, messages, rate))
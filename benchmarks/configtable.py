@@ -0,0 +1,57 @@
+'''Message throughput through ConfigTable.get_entry, the way prefix_resolver calls it.
+
+Runs against an in-memory stand-in for the pool with a fixed query latency, so it measures
+the table's own overhead and how well concurrent misses overlap.
+
+	python -m benchmarks.configtable [guilds] [messages]
+'''
+
+import asyncio
+import sys
+from time import perf_counter
+
+from utils.configtable import ConfigTable
+
+QUERY_LATENCY = 0.002
+
+
+class FakePool:
+	def __init__(self):
+		self.queries = 0
+
+	async def fetchrow(self, query, *args):
+		self.queries += 1
+		await asyncio.sleep(QUERY_LATENCY)
+		return dict(guild_id=args[0], prefix=None, mod_role_id=None, _inserted=False)
+
+	async def execute(self, query, *args):
+		self.queries += 1
+		await asyncio.sleep(QUERY_LATENCY)
+
+
+class FakeBot:
+	def __init__(self, loop):
+		self.loop = loop
+		self.db = FakePool()
+
+
+async def run(guilds, messages):
+	bot = FakeBot(asyncio.get_event_loop())
+	table = ConfigTable(bot, table='config', primary='guild_id')
+
+	async def on_message(idx):
+		await table.get_entry(idx % guilds)
+
+	for name in ('cold', 'warm'):
+		start = perf_counter()
+		await asyncio.gather(*(on_message(idx) for idx in range(messages)))
+		elapsed = perf_counter() - start
+
+		print('{0}: {1:,.0f} msg/s ({2} queries)'.format(name, messages / elapsed, bot.db.queries))
+
+
+if __name__ == '__main__':
+	guilds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+	asyncio.get_event_loop().run_until_complete(run(guilds, messages))
@@ -0,0 +1,196 @@
+'''How late reminders and mod timers fire, with the real timers running against Postgres.
+
+Seeds copies of the `remind` and `mod_timer` tables in a scratch schema of the configured
+database (your own tables are not touched, the schema is dropped afterwards) and runs
+ColumnTimer and EventTimer on them with a stub bot that only records when each listener
+is called. The copies get the indexes of the real tables, so run the migrations first.
+
+Of the seeded rows, `due` fall within the next `seconds` seconds and are expected to fire
+during the run: half spread out evenly, a third front-loaded the way short reminders are,
+and the rest in bursts sharing one timestamp, like everything set for "tomorrow". The other
+rows are spread over the next year and should never be touched.
+
+Reports dispatch lag percentiles, queries per fired record and CPU time of this process.
+
+	python -m benchmarks.timers [rows] [due] [seconds]
+'''
+
+import asyncio
+import random
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter, process_time
+
+import asyncpg
+
+from cogs.mod import EventTimer
+from config import DB_BIND
+from utils.databasetimer import ColumnTimer
+from utils.querystats import QueryStats
+
+SCHEMA = 'bench_timers'
+BURSTS = 5
+
+
+class StubBot:
+	def __init__(self, loop, db):
+		self.loop = loop
+		self.db = db
+		self.listeners = dict()
+
+	def dispatch(self, event_name, *args):
+		# like discord.py, every listener runs in a task of its own
+		for listener in self.listeners.get(event_name, ()):
+			self.loop.create_task(listener(*args))
+
+
+def due_times(now, due, seconds):
+	spread = due // 2
+	early = due // 3
+	burst = due - spread - early
+
+	times = [now + timedelta(seconds=random.uniform(1, seconds)) for _ in range(spread)]
+	times += [now + timedelta(seconds=min(seconds, random.expovariate(4 / seconds) + 1)) for _ in range(early)]
+
+	burst_times = [now + timedelta(seconds=seconds * (idx + 1) / (BURSTS + 1)) for idx in range(BURSTS)]
+	times += [burst_times[idx % BURSTS] for idx in range(burst)]
+
+	return times
+
+
+def future_times(now, count):
+	return [now + timedelta(days=random.uniform(1, 365)) for _ in range(count)]
+
+
+async def create_schema(db):
+	await db.execute('DROP SCHEMA IF EXISTS {0} CASCADE'.format(SCHEMA))
+	await db.execute('CREATE SCHEMA {0}'.format(SCHEMA))
+
+	for table in ('remind', 'mod_timer'):
+		await db.execute('CREATE TABLE {0}.{1} (LIKE public.{1} INCLUDING ALL)'.format(SCHEMA, table))
+
+		# the copied id default would draw from the real table's sequence
+		await db.execute('CREATE SEQUENCE {0}.{1}_id_seq OWNED BY {0}.{1}.id'.format(SCHEMA, table))
+		await db.execute(
+			'ALTER TABLE {0}.{1} ALTER COLUMN id SET DEFAULT nextval(\'{0}.{1}_id_seq\')'.format(SCHEMA, table)
+		)
+
+
+async def seed_remind(db, rows, due, seconds):
+	now = datetime.utcnow()
+	times = due_times(now, due, seconds) + future_times(now, rows - due)
+
+	await db.copy_records_to_table(
+		'remind', schema_name=SCHEMA,
+		columns=('guild_id', 'channel_id', 'user_id', 'message_id', 'made_on', 'remind_on', 'message'),
+		records=[(idx % 1000, idx % 5000, idx, idx, now, when, None) for idx, when in enumerate(times)]
+	)
+
+	await db.execute('ANALYZE {0}.remind'.format(SCHEMA))
+
+
+async def seed_mod_timer(db, rows, due, seconds):
+	now = datetime.utcnow()
+	times = due_times(now, due, seconds) + future_times(now, rows - due)
+
+	# created_at + duration is what EventTimer looks at. (guild_id, user_id, event) is unique
+	await db.copy_records_to_table(
+		'mod_timer', schema_name=SCHEMA,
+		columns=('guild_id', 'user_id', 'mod_id', 'event', 'created_at', 'duration', 'reason', 'userdata'),
+		records=[
+			(idx % 1000, idx, None, 'BAN' if idx % 2 else 'MUTE', now, when - now, None, None)
+			for idx, when in enumerate(times)
+		]
+	)
+
+	await db.execute('ANALYZE {0}.mod_timer'.format(SCHEMA))
+
+
+def percentile(values, p):
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run_timer(name, pool, query_stats, make_timer, due, seconds):
+	bot = StubBot(asyncio.get_event_loop(), pool)
+	lags = list()
+	done = asyncio.Event()
+
+	async def listener(record):
+		lags.append((datetime.utcnow() - timer.when(record)).total_seconds())
+
+		if len(lags) >= due:
+			done.set()
+
+	bot.listeners[name] = [listener]
+
+	queries_before = sum(stats.calls for stats in query_stats.templates.values())
+	cpu_before = process_time()
+	start = perf_counter()
+
+	timer = make_timer(bot)
+
+	try:
+		await asyncio.wait_for(done.wait(), timeout=seconds + 30)
+	except asyncio.TimeoutError:
+		print('{0}: timed out with {1}/{2} records fired'.format(name, len(lags), due))
+
+	timer.task.cancel()
+
+	wall = perf_counter() - start
+	cpu = process_time() - cpu_before
+	queries = sum(stats.calls for stats in query_stats.templates.values()) - queries_before
+
+	if not lags:
+		return
+
+	lags.sort()
+
+	print(
+		'{0}: {1:,} fired in {2:.1f}s, lag p50 {3:.1f}ms p99 {4:.1f}ms max {5:.1f}ms, '
+		'{6:.3f} queries/record, {7:.2f}s cpu'.format(
+			name, len(lags), wall, percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000, lags[-1] * 1000,
+			queries / len(lags), cpu
+		)
+	)
+
+
+async def run(rows, due, seconds):
+	query_stats = QueryStats(slow_threshold=None)
+	query_stats.install()
+
+	db = await asyncpg.connect(DB_BIND)
+	await create_schema(db)
+
+	pool = await asyncpg.create_pool(DB_BIND, server_settings=dict(search_path='{0},public'.format(SCHEMA)))
+
+	# one timer at a time, seeded right before it runs, so the cpu times don't mix
+	try:
+		print('Seeding {0:,} reminders, {1:,} due in the next {2}s'.format(rows, due, seconds))
+		await seed_remind(db, rows, due, seconds)
+
+		await run_timer(
+			'reminder_complete', pool, query_stats,
+			lambda bot: ColumnTimer(bot, 'reminder_complete', table='remind', column='remind_on'),
+			due, seconds
+		)
+
+		print('Seeding {0:,} mod timers, {1:,} due in the next {2}s'.format(rows, due, seconds))
+		await seed_mod_timer(db, rows, due, seconds)
+
+		await run_timer(
+			'event_complete', pool, query_stats,
+			lambda bot: EventTimer(bot, 'event_complete'),
+			due, seconds
+		)
+	finally:
+		await pool.close()
+		await db.execute('DROP SCHEMA IF EXISTS {0} CASCADE'.format(SCHEMA))
+		await db.close()
+
+
+if __name__ == '__main__':
+	rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	due = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+	seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+
+	asyncio.get_event_loop().run_until_complete(run(rows, due, seconds))
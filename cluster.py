@@ -0,0 +1,342 @@
+'''Runs the bot as a cluster of worker processes, each running its own slice of the shards.
+
+The supervisor in this file starts the workers, restarts any that crash, and combines the
+health and guild counts they report. It is also what posts the total guild count to DBL.
+
+	python cluster.py
+
+With `--check` it instead checks how shards are split, then starts the workers with a stand-in
+for the bot that only reports a status, and waits for every worker to report. That covers
+starting the worker processes, their event loops and status reporting, without connecting
+to Discord.
+
+	python cluster.py --check [shard_count] [workers]
+'''
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+from time import monotonic
+
+import aiohttp
+
+import ace
+import config
+from config import BOT_TOKEN, DBL_KEY
+
+# optional settings, these might not be present in older config files
+CLUSTER_WORKERS = getattr(config, 'CLUSTER_WORKERS', 2)
+SHARD_COUNT = getattr(config, 'SHARD_COUNT', None)
+
+GATEWAY_URL = 'https://discord.com/api/v8/gateway/bot'
+
+CHECK_INTERVAL = 5
+SUMMARY_INTERVAL = 5 * 60
+DBL_INTERVAL = 30 * 60
+
+# a worker is unhealthy if it hasn't reported in this long
+STALE_AFTER = ace.STATUS_INTERVAL * 3
+
+# restart delay doubles for each crash that happens soon after the previous start
+RESTART_DELAY = 5.0
+MAX_RESTART_DELAY = 300.0
+STABLE_AFTER = 120.0
+
+# workers must not inherit the running event loop of the supervisor
+mp = multiprocessing.get_context('spawn')
+
+log = logging.getLogger('cluster')
+
+
+def split_shards(shard_count, workers):
+	'''Split shard IDs into `workers` contiguous ranges of (nearly) equal size.'''
+
+	workers = min(workers, shard_count)
+	per, extra = divmod(shard_count, workers)
+
+	ranges = list()
+	start = 0
+
+	for idx in range(workers):
+		end = start + per + (1 if idx < extra else 0)
+		ranges.append(list(range(start, end)))
+		start = end
+
+	return ranges
+
+
+class Worker:
+	def __init__(self, worker_id, shard_ids, shard_count, status_queue, main=None):
+		self.worker_id = worker_id
+		self.shard_ids = shard_ids
+		self.shard_count = shard_count
+		self.status_queue = status_queue
+		self.main = main
+
+		self.process = None
+		self.started_at = None
+		self.restart_at = None
+		self.restart_delay = RESTART_DELAY
+		self.restarts = 0
+
+		self.status = None
+		self.status_at = None
+
+	def start(self):
+		self.process = mp.Process(
+			target=ace.run_worker,
+			args=(self.worker_id, self.shard_ids, self.shard_count, self.status_queue, self.main),
+			name='ace-worker-{0}'.format(self.worker_id),
+		)
+
+		self.process.start()
+
+		self.started_at = monotonic()
+		self.restart_at = None
+		self.status = None
+		self.status_at = None
+
+		log.info('Started worker %s (pid %s) with shards %s', self.worker_id, self.process.pid, self.shard_ids)
+
+	def stop(self):
+		if self.process is not None and self.process.is_alive():
+			self.process.terminate()
+			self.process.join(10)
+
+	@property
+	def alive(self):
+		return self.process is not None and self.process.is_alive()
+
+	@property
+	def healthy(self):
+		if not self.alive or self.status is None:
+			return False
+
+		return self.status['ready'] and not self.status['closed'] and monotonic() - self.status_at < STALE_AFTER
+
+	@property
+	def guilds(self):
+		return 0 if self.status is None else self.status['guilds']
+
+	def check(self):
+		'''Schedule and perform restarts of a dead worker.'''
+
+		if self.alive:
+			return
+
+		now = monotonic()
+
+		if self.restart_at is None:
+			# back off if the worker keeps dying shortly after starting
+			if now - self.started_at < STABLE_AFTER:
+				self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+			else:
+				self.restart_delay = RESTART_DELAY
+
+			self.restart_at = now + self.restart_delay
+
+			log.warning(
+				'Worker %s exited with code %s, restarting in %s seconds',
+				self.worker_id, self.process.exitcode, self.restart_delay
+			)
+
+		elif now >= self.restart_at:
+			self.restarts += 1
+			self.start()
+
+
+class Supervisor:
+	def __init__(self, worker_count, shard_count=None, main=None):
+		self.worker_count = worker_count
+		self.shard_count = shard_count
+		self.main = main
+
+		self.status_queue = mp.Queue()
+		self.workers = list()
+
+		self.user_id = None
+
+	async def get_recommended_shards(self, session):
+		headers = dict(Authorization='Bot ' + BOT_TOKEN)
+
+		async with session.get(GATEWAY_URL, headers=headers) as resp:
+			resp.raise_for_status()
+			data = await resp.json()
+
+		return data['shards']
+
+	def read_statuses(self):
+		while True:
+			try:
+				status = self.status_queue.get_nowait()
+			except queue.Empty:
+				return
+
+			worker = self.workers[status['worker_id']]
+			worker.status = status
+			worker.status_at = monotonic()
+
+			if status['user_id'] is not None:
+				self.user_id = status['user_id']
+
+	@property
+	def guild_count(self):
+		return sum(worker.guilds for worker in self.workers)
+
+	def log_summary(self):
+		healthy = sum(1 for worker in self.workers if worker.healthy)
+
+		log.info(
+			'%s/%s workers healthy, %s guilds, %s restarts',
+			healthy, len(self.workers), self.guild_count, sum(worker.restarts for worker in self.workers)
+		)
+
+		for worker in self.workers:
+			if not worker.healthy:
+				log.warning('Worker %s (shards %s) is unhealthy', worker.worker_id, worker.shard_ids)
+
+	async def update_dbl(self, session):
+		if DBL_KEY is None or self.user_id is None:
+			return
+
+		# only post once every worker has reported, otherwise the count would be too low
+		if any(worker.status is None for worker in self.workers):
+			return
+
+		try:
+			await ace.post_dbl(session, self.user_id, self.guild_count, shard_count=self.shard_count)
+		except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+			log.warning('Failed updating DBL: %s', str(exc))
+
+	async def run(self):
+		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+			if self.shard_count is None:
+				self.shard_count = await self.get_recommended_shards(session)
+				log.info('Using recommended shard count %s', self.shard_count)
+
+			for worker_id, shard_ids in enumerate(split_shards(self.shard_count, self.worker_count)):
+				worker = Worker(worker_id, shard_ids, self.shard_count, self.status_queue, self.main)
+				self.workers.append(worker)
+				worker.start()
+
+			last_summary = last_dbl = monotonic()
+
+			while True:
+				await asyncio.sleep(CHECK_INTERVAL)
+
+				self.read_statuses()
+
+				for worker in self.workers:
+					worker.check()
+
+				now = monotonic()
+
+				if now - last_summary >= SUMMARY_INTERVAL:
+					self.log_summary()
+					last_summary = now
+
+				if now - last_dbl >= DBL_INTERVAL:
+					await self.update_dbl(session)
+					last_dbl = now
+
+	def stop(self):
+		log.info('Stopping workers')
+
+		for worker in self.workers:
+			worker.stop()
+
+
+async def check_worker(shard_ids, shard_count, status_queue, worker_id):
+	'''Stand-in for `ace.setup` that reports a healthy status and stays up.'''
+
+	while True:
+		status_queue.put_nowait(dict(
+			worker_id=worker_id, user_id=None, shard_ids=shard_ids, ready=True, closed=False, guilds=len(shard_ids),
+			latency=0.0,
+		))
+
+		await asyncio.sleep(1.0)
+
+
+def check_split_shards():
+	failed = 0
+
+	for shard_count in range(1, 65):
+		for workers in range(1, 17):
+			ranges = split_shards(shard_count, workers)
+			sizes = set(len(shard_ids) for shard_ids in ranges)
+
+			ok = (
+				[shard_id for shard_ids in ranges for shard_id in shard_ids] == list(range(shard_count))
+				and len(ranges) == min(workers, shard_count)
+				and min(sizes) > 0 and max(sizes) - min(sizes) <= 1
+			)
+
+			if not ok:
+				failed += 1
+				print('split_shards({0}, {1}) is wrong: {2}'.format(shard_count, workers, ranges))
+
+	return failed == 0
+
+
+async def check_workers(shard_count, workers, timeout=CHECK_INTERVAL * 4):
+	supervisor = Supervisor(workers, shard_count, main=check_worker)
+	task = asyncio.get_event_loop().create_task(supervisor.run())
+
+	try:
+		start = monotonic()
+
+		while monotonic() - start < timeout:
+			await asyncio.sleep(1.0)
+
+			if supervisor.workers and all(worker.healthy for worker in supervisor.workers):
+				break
+
+		healthy = [worker.healthy for worker in supervisor.workers]
+	finally:
+		task.cancel()
+		supervisor.stop()
+
+	ok = bool(healthy)
+
+	for worker, is_healthy in zip(supervisor.workers, healthy):
+		if is_healthy:
+			print('Worker {0} (shards {1}) is healthy'.format(worker.worker_id, worker.shard_ids))
+		else:
+			ok = False
+			print('Worker {0} (shards {1}) never reported, exit code {2}'.format(
+				worker.worker_id, worker.shard_ids, worker.process and worker.process.exitcode
+			))
+
+	if ok:
+		print('{0} guilds reported in total'.format(supervisor.guild_count))
+
+	return ok
+
+
+if __name__ == '__main__':
+	if not os.path.exists('logs'):
+		os.makedirs('logs')
+
+	ace.setup_logger('logs/cluster.log')
+
+	if len(sys.argv) > 1 and sys.argv[1] == '--check':
+		shard_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+		workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+		ok = check_split_shards()
+		ok = asyncio.get_event_loop().run_until_complete(check_workers(shard_count, workers)) and ok
+
+		sys.exit(0 if ok else 1)
+
+	supervisor = Supervisor(CLUSTER_WORKERS, SHARD_COUNT)
+
+	try:
+		asyncio.get_event_loop().run_until_complete(supervisor.run())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		supervisor.stop()
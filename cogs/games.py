@@ -134,7 +134,8 @@ class Games(AceMixin, commands.Cog):
 	def __init__(self, bot):
 		super().__init__(bot)
 
-		self.config = ConfigTable(bot, 'trivia', ('guild_id', 'user_id'))
+		# one entry per player, so keep this one bounded
+		self.config = ConfigTable(bot, 'trivia', ('guild_id', 'user_id'), max_entries=4096, ttl=3600.0)
 
 		self.trivia_categories = None
 
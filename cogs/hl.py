@@ -7,6 +7,7 @@ from ids import AHK_GUILD_ID
 from cogs.mixins import AceMixin
 from utils.context import is_mod
 from utils.converters import LengthConverter
+from utils.queries import register
 
 DELETE_EMOJI = '\N{Put Litter in Its Place Symbol}'
 DEFAULT_LANG = 'py'
@@ -24,6 +25,14 @@ class LangConverter(LengthConverter):
 
 lang_converter = LangConverter(1, 32)
 
+LANG_LOOKUP = register(
+	'hl.lang', 'SELECT lang FROM highlight_lang WHERE guild_id=$1 AND (user_id=$2 OR user_id=$3)'
+)
+HL_INSERT = register(
+	'hl.insert', 'INSERT INTO highlight_msg (guild_id, channel_id, user_id, message_id) VALUES ($1, $2, $3, $4)'
+)
+HL_DELETE = register('hl.delete', 'DELETE FROM highlight_msg WHERE user_id=$1 AND message_id=$2')
+
 
 class Highlighter(AceMixin, commands.Cog):
 	'''Create highlighted code-boxes with one command.'''
@@ -48,10 +57,7 @@ class Highlighter(AceMixin, commands.Cog):
 		code = code.strip()
 
 		# get the language this user should use
-		lang = await self.db.fetchval(
-			'SELECT lang FROM highlight_lang WHERE guild_id=$1 AND (user_id=$2 OR user_id=$3)',
-			ctx.guild.id, 0, ctx.author.id
-		) or DEFAULT_LANG
+		lang = await LANG_LOOKUP.fetchval(self.db, ctx.guild.id, 0, ctx.author.id) or DEFAULT_LANG
 
 		code = '```{}\n{}\n```'.format(lang, code)
 		code += '*Paste by {0} - Click {1} to delete.*'.format(ctx.author.mention, DELETE_EMOJI)
@@ -61,10 +67,7 @@ class Highlighter(AceMixin, commands.Cog):
 
 		message = await ctx.send(code)
 
-		await self.db.execute(
-			'INSERT INTO highlight_msg (guild_id, channel_id, user_id, message_id) VALUES ($1, $2, $3, $4)',
-			ctx.guild.id, ctx.channel.id, ctx.author.id, message.id
-		)
+		await HL_INSERT.execute(self.db, ctx.guild.id, ctx.channel.id, ctx.author.id, message.id)
 
 		await message.add_reaction(DELETE_EMOJI)
 
@@ -78,10 +81,7 @@ class Highlighter(AceMixin, commands.Cog):
 		if str(payload.emoji) != DELETE_EMOJI or payload.user_id == self.bot.user.id:
 			return
 
-		if await self.db.execute(
-			'DELETE FROM highlight_msg WHERE user_id=$1 AND message_id=$2',
-			payload.user_id, payload.message_id
-		) == 'DELETE 0':
+		if await HL_DELETE.execute(self.db, payload.user_id, payload.message_id) == 'DELETE 0':
 			return
 
 		channel = self.bot.get_channel(payload.channel_id)
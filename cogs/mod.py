@@ -4,14 +4,15 @@ import io
 import logging
 import shlex
 from typing import Union
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta
 from enum import Enum, IntEnum
 from json import dumps, loads
+from time import monotonic
 
 import discord
 from asyncpg.exceptions import UniqueViolationError
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from cogs.mixins import AceMixin
 from ids import AHK_GUILD_ID, RULES_MSG_ID
@@ -21,17 +22,36 @@ from utils.converters import MaxLengthConverter, MaybeMemberConverter, RangeConv
 from utils.databasetimer import DatabaseTimer
 from utils.fakeuser import FakeUser
 from utils.pager import Pager
+from utils.queries import register
+from utils.ratelimit import DuplicateDetector, RateLimiter, SlidingWindowCounter
 from utils.string import po
 from utils.time import TimeDeltaConverter, TimeMultConverter, pretty_datetime, pretty_timedelta
 
 log = logging.getLogger(__name__)
 
+TIMER_LOOKUP = register('mod_timer.lookup', 'SELECT id FROM mod_timer WHERE guild_id=$1 AND user_id=$2 AND event=$3')
+TIMER_DELETE = register(
+	'mod_timer.delete', 'DELETE FROM mod_timer WHERE guild_id=$1 AND user_id=$2 AND event=$3 RETURNING id'
+)
+MUTE_INSERT = register(
+	'mod_timer.insert_mute',
+	'INSERT INTO mod_timer (guild_id, user_id, event, created_at, userdata) VALUES ($1, $2, $3, $4, $5)'
+)
+
 MAX_DELTA = timedelta(days=365 * 10)
 OK_EMOJI = '\U00002705'
 
-SPAM_LOCK = asyncio.Lock()
-MENTION_LOCK = asyncio.Lock()
-CONTENT_LOCK = asyncio.Lock()
+# how often refilled anti-spam buckets are dropped
+RATE_LIMIT_SWEEP_INTERVAL = 60.0
+
+# raid mode ends after this many seconds without suspicious joins
+RAID_QUIET = 60.0
+
+# most members listed by name in a raid summary
+RAID_SUMMARY_MEMBERS = 20
+
+# members punished within this many seconds aren't queued for punishment again
+PUNISHMENT_DEDUPE = 30.0
 
 MOD_PERMS = (
 	'administrator',
@@ -88,47 +108,26 @@ class SeverityColors(Enum):
 	RESOLVED = 0x32CD32
 
 
+# posting the same message in another channel counts as this many extra messages
 OTHER_CHANNEL_PENALTY = 2
 
-
-class CooldownByContent(commands.CooldownMapping):
-	def __init__(self, original):
-		super().__init__(original)
-
-		self.bucket_to_channel = dict()
-
-	def _bucket_key(self, message):
-		return (message.guild.id, message.author.id, message.content)
-
-	def update_rate_limit(self, message, current=None):
-		bucket = self.get_bucket(message, current)
-
-		current_channel_id = message.channel.id
-		prev_channel_id = self.bucket_to_channel.get(bucket, None)
-
-		self.bucket_to_channel[bucket] = current_channel_id
-
-		ret = bucket.update_rate_limit(current)
-
-		if prev_channel_id is not None and current_channel_id != prev_channel_id:
-			for _ in range(OTHER_CHANNEL_PENALTY):
-				ret = bucket.update_rate_limit(current)
-				if ret is not None:
-					break
-
-		return ret
+# most (member, message content) pairs tracked per guild
+CONTENT_MAX_ENTRIES = 10000
 
 
 class SecurityConfigRecord(ConfigTableRecord):
 	spam_cooldown = None
 	mention_cooldown = None
 	content_cooldown = None
+	join_rate = None
+	recent_joins = None
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.create_spam_cooldown()
 		self.create_mention_cooldown()
 		self.create_content_cooldown()
+		self.create_join_rate()
 
 	@property
 	def guild(self):
@@ -158,36 +157,299 @@ class SecurityConfigRecord(ConfigTableRecord):
 		return guild.get_channel(self.log_channel_id)
 
 	def create_spam_cooldown(self):
-		self.spam_cooldown = commands.CooldownMapping.from_cooldown(
-			self.spam_count, self.spam_per, commands.BucketType.member
-		)
+		self.spam_cooldown = RateLimiter(self.spam_count, self.spam_per)
 
 	def create_mention_cooldown(self):
-		self.mention_cooldown = commands.CooldownMapping.from_cooldown(
-			self.mention_count, self.mention_per, commands.BucketType.member
-		)
+		self.mention_cooldown = RateLimiter(self.mention_count, self.mention_per)
+
+	def mention_cost(self, message):
+		'''Weighted amount of mentions in a message.'''
+
+		cost = len(message.mentions) + len(message.role_mentions) * self.mention_role_weight
+
+		if message.mention_everyone:
+			cost += self.mention_everyone_weight
+
+		return cost
+
+	def create_join_rate(self):
+		self.join_rate = SlidingWindowCounter(self.raid_per)
+
+		# the suspicious joins that can start a raid, punished once it does
+		self.recent_joins = deque(maxlen=self.raid_count)
+
+	def is_suspicious(self, member):
+		'''Whether a joining member matches the raid filters. Without filters every member does.'''
+
+		if self.raid_age is not None and datetime.utcnow() - member.created_at > self.raid_age:
+			return False
+
+		if self.raid_default_avatar and member.avatar is not None:
+			return False
+
+		return True
 
 	def create_content_cooldown(self):
-		self.content_cooldown = CooldownByContent.from_cooldown(
-			5, 32.0, commands.BucketType.member
+		self.content_cooldown = DuplicateDetector(
+			5, 32.0, penalty=OTHER_CHANNEL_PENALTY, max_entries=CONTENT_MAX_ENTRIES
 		)
 
 
 class EventTimer(DatabaseTimer):
-	async def get_record(self):
-		return await self.bot.db.fetchrow(
-			'SELECT * FROM mod_timer WHERE duration IS NOT NULL AND created_at + duration < $1 '
-			'ORDER BY created_at + duration LIMIT 1',
-			datetime.utcnow() + self.MAX_SLEEP
+	async def get_records(self, until):
+		shard_sql, shard_args = self.shard_predicate(start_at=2)
+
+		return await self.bot.db.fetch(
+			'SELECT * FROM mod_timer WHERE duration IS NOT NULL AND created_at + duration < $1 AND {0}'.format(shard_sql),
+			until, *shard_args
 		)
 
-	async def cleanup_record(self, record):
-		await self.bot.db.execute('DELETE FROM mod_timer WHERE id=$1', record.get('id'))
+	async def claim_records(self, now):
+		shard_sql, shard_args = self.shard_predicate(start_at=2)
+
+		return await self.bot.db.fetch(
+			'DELETE FROM mod_timer WHERE duration IS NOT NULL AND created_at + duration <= $1 AND {0} '
+			'RETURNING *'.format(shard_sql),
+			now, *shard_args
+		)
 
 	def when(self, record):
 		return record.get('created_at') + record.get('duration')
 
 
+async def _apply_action(conf, member, action, reason, delete_message_days):
+	if action is SecurityAction.MUTE:
+		mute_role = conf.mute_role
+
+		if mute_role is None:
+			raise ValueError('No mute role set.')
+
+		await member.add_roles(mute_role, reason=reason)
+
+	elif action is SecurityAction.KICK:
+		await member.kick(reason=reason)
+
+	elif action is SecurityAction.BAN:
+		await member.ban(delete_message_days=delete_message_days, reason=reason)
+
+
+async def apply_action(conf, member, action, reason, delete_message_days=0):
+	'''Perform a security action on a member. Raises ValueError if it can't be done with the current config.'''
+
+	try:
+		await _apply_action(conf, member, action, reason, delete_message_days)
+	except discord.HTTPException as exc:
+		if exc.status != 429:
+			raise
+
+		# discord.py gave up retrying, back off before one last attempt
+		await asyncio.sleep(float(exc.response.headers.get('Retry-After', 1.0)))
+		await _apply_action(conf, member, action, reason, delete_message_days)
+
+
+class Punishment:
+	__slots__ = ('message', 'action', 'reason', 'delete_message_days', 'fields')
+
+	def __init__(self, message, action, reason, delete_message_days, fields):
+		self.message = message
+		self.action = action
+		self.reason = reason
+		self.delete_message_days = delete_message_days
+		self.fields = fields
+
+
+class PunishmentQueue:
+	'''Security actions waiting to be performed in a guild.
+
+	Actions are performed one at a time by a task that runs while the queue isn't empty, so a
+	spam wave never has more than one punishment request in flight per guild. A member already
+	waiting in the queue or punished in the last PUNISHMENT_DEDUPE seconds isn't queued again
+	unless the new action is harsher, which replaces a waiting one. Channel notices are sent
+	once the queue is empty, one message per channel.
+	'''
+
+	def __init__(self, cog, guild_id):
+		self.cog = cog
+		self.guild_id = guild_id
+
+		self.pending = OrderedDict()
+		self.recent = OrderedDict()
+		self.notices = OrderedDict()
+
+		self.task = None
+		self.dropped = 0
+
+	@property
+	def idle(self):
+		return not self.pending and not self.recent and (self.task is None or self.task.done())
+
+	def expire(self, now=None):
+		if now is None:
+			now = monotonic()
+
+		while self.recent:
+			if next(iter(self.recent.values()))[0] > now - PUNISHMENT_DEDUPE:
+				break
+
+			self.recent.popitem(last=False)
+
+	def add(self, message, action, reason, delete_message_days=0, **fields):
+		member_id = message.author.id
+
+		self.expire()
+
+		recent = self.recent.get(member_id, None)
+		pending = self.pending.get(member_id, None)
+
+		if (recent is not None and recent[1] >= action) or (pending is not None and pending.action >= action):
+			self.dropped += 1
+			return
+
+		self.pending[member_id] = Punishment(message, action, reason, delete_message_days, fields)
+
+		if self.task is None or self.task.done():
+			self.task = self.cog.bot.loop.create_task(self.run())
+
+	async def run(self):
+		while self.pending:
+			member_id, punishment = self.pending.popitem(last=False)
+
+			# anything no harsher coming in while it's being punished is dropped
+			self.recent.pop(member_id, None)
+			self.recent[member_id] = (monotonic(), punishment.action)
+
+			try:
+				notice = await self.cog.punish(punishment)
+			except Exception:
+				log.exception('Failed punishing member %s in guild %s', member_id, self.guild_id)
+				notice = None
+
+			if notice is not None:
+				self.notices.setdefault(punishment.message.channel, list()).append(notice)
+
+			if not self.pending:
+				await self.flush_notices()
+
+	async def flush_notices(self):
+		while self.notices:
+			channel, lines = self.notices.popitem(last=False)
+
+			for content in chunk_lines(lines):
+				try:
+					await channel.send(content)
+				except discord.HTTPException:
+					break
+
+
+def chunk_lines(lines, limit=2000):
+	'''Join lines into as few messages as fit the message length limit.'''
+
+	content = ''
+
+	for line in lines:
+		line = line[:limit]
+
+		if content and len(content) + len(line) + 1 > limit:
+			yield content
+			content = ''
+
+		content = line if not content else content + '\n' + line
+
+	if content:
+		yield content
+
+
+class Raid:
+	'''A raid in progress in a guild.
+
+	Suspicious members joining are queued and punished one at a time, so a raid never has more
+	than one request in flight per guild and leaves room in the route buckets for everything
+	else. Ends after RAID_QUIET seconds without suspicious joins, then logs a summary.
+	'''
+
+	def __init__(self, cog, conf):
+		self.cog = cog
+		self.conf = conf
+		self.guild_id = conf.guild_id
+
+		self.action = SecurityAction[conf.raid_action]
+		self.started_at = datetime.utcnow()
+
+		self.queue = asyncio.Queue()
+		self.punished = list()
+		self.failed = list()
+
+		self.task = self.cog.bot.loop.create_task(self.run())
+
+	def add(self, member):
+		self.queue.put_nowait(member)
+
+	async def run(self):
+		try:
+			while True:
+				try:
+					member = await asyncio.wait_for(self.queue.get(), timeout=RAID_QUIET)
+				except asyncio.TimeoutError:
+					break
+
+				await self.punish(member)
+		finally:
+			self.cog.raids.pop(self.guild_id, None)
+
+		log.info('Raid ended in guild %s: %s punished, %s failed', self.guild_id, len(self.punished), len(self.failed))
+
+		try:
+			await self.summarize()
+		except discord.HTTPException as exc:
+			log.warning('Failed posting raid summary in guild %s: %s', self.guild_id, str(exc))
+
+	async def punish(self, member):
+		try:
+			await apply_action(self.conf, member, self.action, 'Member joined during a raid', delete_message_days=1)
+		except (discord.HTTPException, ValueError) as exc:
+			self.failed.append((member, str(exc)))
+		else:
+			self.punished.append(member)
+
+	async def summarize(self):
+		log_channel = self.conf.log_channel
+		if log_channel is None:
+			return
+
+		ended_at = datetime.utcnow()
+		severity = Severity.HIGH if self.failed else Severity.RESOLVED
+		verb = SecurityVerb[self.action.name].value.capitalize()
+
+		e = discord.Embed(
+			title='RAID',
+			description='{0} {1} members, {2} failed.'.format(verb, len(self.punished), len(self.failed)),
+			color=SeverityColors[severity.name].value,
+			timestamp=ended_at
+		)
+
+		e.add_field(name='Duration', value=pretty_timedelta(ended_at - self.started_at), inline=False)
+
+		if self.punished:
+			e.add_field(name=verb, value=self._list_members(self.punished), inline=False)
+
+		if self.failed:
+			e.add_field(name='Failed', value=self._list_members(member for member, _ in self.failed), inline=False)
+			e.add_field(name='Last error', value=self.failed[-1][1], inline=False)
+
+		e.set_footer(text=severity.name)
+
+		await log_channel.send(embed=e)
+
+	def _list_members(self, members):
+		members = list(members)
+		lines = [po(member) for member in members[:RAID_SUMMARY_MEMBERS]]
+
+		if len(members) > RAID_SUMMARY_MEMBERS:
+			lines.append('and {0} more'.format(len(members) - RAID_SUMMARY_MEMBERS))
+
+		return '\n'.join(lines)
+
+
 # ripped from RoboDanny
 class BannedMember(commands.Converter):
 	async def convert(self, ctx, argument):
@@ -262,6 +524,9 @@ def can_mute():
 reason_converter = MaxLengthConverter(1024)
 count_converter = RangeConverter(8, 24)
 interval_converter = RangeConverter(8, 24)
+weight_converter = RangeConverter(0, 8)
+raid_count_converter = RangeConverter(3, 50)
+raid_interval_converter = RangeConverter(5, 60)
 
 
 class Moderation(AceMixin, commands.Cog):
@@ -272,6 +537,35 @@ class Moderation(AceMixin, commands.Cog):
 
 		self.config = ConfigTable(bot, 'mod_config', 'guild_id', record_class=SecurityConfigRecord)
 		self.event_timer = EventTimer(bot, 'event_complete')
+		self.raids = dict()
+		self.punishments = dict()
+
+		self.sweeper.start()
+
+	def cog_unload(self):
+		self.sweeper.cancel()
+
+		for raid in self.raids.values():
+			raid.task.cancel()
+
+		for queue in self.punishments.values():
+			if queue.task is not None:
+				queue.task.cancel()
+
+	@tasks.loop(seconds=RATE_LIMIT_SWEEP_INTERVAL)
+	async def sweeper(self):
+		'''Drops anti-spam buckets of members that have stopped sending messages, and idle punishment queues.'''
+
+		for conf in self.config.entries.values():
+			conf.spam_cooldown.sweep()
+			conf.mention_cooldown.sweep()
+			conf.content_cooldown.expire()
+
+		for guild_id, queue in list(self.punishments.items()):
+			queue.expire()
+
+			if queue.idle:
+				self.punishments.pop(guild_id)
 
 	@commands.Cog.listener()
 	async def on_log(self, guild, subject, action=None, severity=Severity.LOW, message=None, **fields):
@@ -433,7 +727,6 @@ class Moderation(AceMixin, commands.Cog):
 
 		now = datetime.utcnow()
 		duration = amount * unit
-		until = now + duration
 
 		if await ctx.is_mod(member):
 			raise commands.CommandError('Can\'t mute this member.')
@@ -452,9 +745,9 @@ class Moderation(AceMixin, commands.Cog):
 		async with self.db.acquire() as con:
 			async with con.transaction():
 				try:
-					await con.execute(
+					record = await con.fetchrow(
 						'INSERT INTO mod_timer (guild_id, user_id, mod_id, event, created_at, duration, reason, userdata) '
-						'VALUES ($1, $2, $3, $4, $5, $6, $7, $8)',
+						'VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING *',
 						ctx.guild.id, member.id, ctx.author.id, 'MUTE', now, duration, reason, self._craft_user_data(member)
 					)
 				except UniqueViolationError:
@@ -465,7 +758,7 @@ class Moderation(AceMixin, commands.Cog):
 				except discord.HTTPException:
 					raise commands.CommandError('Failed adding mute role.')
 
-		self.event_timer.maybe_restart(until)
+		self.event_timer.add(record)
 
 		pretty_duration = pretty_timedelta(duration)
 
@@ -487,7 +780,6 @@ class Moderation(AceMixin, commands.Cog):
 
 		now = datetime.utcnow()
 		duration = amount * unit
-		until = now + duration
 
 		on_guild = isinstance(member, discord.Member)
 
@@ -498,10 +790,7 @@ class Moderation(AceMixin, commands.Cog):
 			user: discord.User = member.user
 			member = FakeUser(user.id, ctx.guild, name=user.name, avatar_url=user.avatar_url, discriminator=user.discriminator)
 
-		is_tempbanned = await self.bot.db.fetchval(
-			'SELECT id FROM mod_timer WHERE guild_id=$1 AND user_id=$2 AND event=$3',
-			ctx.guild.id, member.id, 'BAN'
-		)
+		is_tempbanned = await TIMER_LOOKUP.fetchval(self.db, ctx.guild.id, member.id, 'BAN')
 
 		if is_tempbanned:
 			raise commands.CommandError('This member is already tempbanned. Use `alterban` to change duration?')
@@ -526,9 +815,9 @@ class Moderation(AceMixin, commands.Cog):
 		async with self.db.acquire() as con:
 			async with con.transaction():
 				try:
-					await self.db.execute(
+					record = await self.db.fetchrow(
 						'INSERT INTO mod_timer (guild_id, user_id, mod_id, event, created_at, duration, reason, userdata) '
-						'VALUES ($1, $2, $3, $4, $5, $6, $7, $8)',
+						'VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING *',
 						ctx.guild.id, member.id, ctx.author.id, 'BAN', now, duration, reason, self._craft_user_data(member)
 					)
 				except UniqueViolationError:
@@ -540,7 +829,7 @@ class Moderation(AceMixin, commands.Cog):
 				except discord.HTTPException:
 					raise commands.CommandError('Failed tempbanning member.')
 
-		self.event_timer.maybe_restart(until)
+		self.event_timer.add(record)
 
 		try:
 			await ctx.send('{0} tempbanned for {1}.'.format(str(member), pretty_duration))
@@ -599,12 +888,15 @@ class Moderation(AceMixin, commands.Cog):
 		if not should_continue:
 			return
 
-		await self.db.execute(
-			'UPDATE mod_timer SET duration=$1 WHERE guild_id=$2 AND user_id=$3 AND event=$4',
-			duration, ctx.guild.id, member.user.id, 'BAN'
+		new_record = await self.db.fetchrow(
+			'UPDATE mod_timer SET duration=$1 WHERE id=$2 RETURNING *',
+			duration, record.get('id')
 		)
 
-		self.event_timer.restart_task()
+		self.event_timer.remove_if(lambda r: r.get('id') == record.get('id'))
+
+		if new_record is not None:
+			self.event_timer.add(new_record)
 
 		self.bot.dispatch(
 			'log', ctx.guild, member.user, action='TEMPBAN UPDATE', severity=Severity.HIGH, message=ctx.message,
@@ -619,10 +911,11 @@ class Moderation(AceMixin, commands.Cog):
 
 		event = record.get('event')
 
-		if event == 'MUTE':
-			await self.mute_complete(record)
-		elif event == 'BAN':
-			await self.ban_complete(record)
+		async with self.event_timer.limit:
+			if event == 'MUTE':
+				await self.mute_complete(record)
+			elif event == 'BAN':
+				await self.ban_complete(record)
 
 	async def mute_complete(self, record):
 		conf = await self.config.get_entry(record.get('guild_id'))
@@ -707,14 +1000,11 @@ class Moderation(AceMixin, commands.Cog):
 	@commands.Cog.listener()
 	async def on_member_unban(self, guild, user):
 		# remove tempbans if user is manually unbanned
-		_id = await self.db.fetchval(
-			'DELETE FROM mod_timer WHERE guild_id=$1 AND user_id=$2 AND event=$3 RETURNING id',
-			guild.id, user.id, 'BAN'
-		)
+		_id = await TIMER_DELETE.fetchval(self.db, guild.id, user.id, 'BAN')
 
-		# also restart timer if the next in line *was* that tempban
+		# also unschedule that tempban
 		if _id is not None:
-			self.event_timer.restart_if(lambda r: r.get('id') == _id)
+			self.event_timer.remove_if(lambda r: r.get('id') == _id)
 
 			self.bot.dispatch(
 				'log', guild, user, action='TEMPBAN CANCELLED', severity=Severity.RESOLVED,
@@ -743,39 +1033,35 @@ class Moderation(AceMixin, commands.Cog):
 
 		if before_has:
 			# mute role removed
-			_id = await self.db.fetchval(
-				'DELETE FROM mod_timer WHERE guild_id=$1 AND user_id=$2 AND event=$3 RETURNING id',
-				after.guild.id, after.id, 'MUTE'
-			)
+			_id = await TIMER_DELETE.fetchval(self.db, after.guild.id, after.id, 'MUTE')
 
-			self.event_timer.restart_if(lambda r: r.get('id') == _id)
+			self.event_timer.remove_if(lambda r: r.get('id') == _id)
 
 		elif after_has:  # not strictly necessary but more explicit
 			# mute role added
 			try:
-				await self.db.execute(
-					'INSERT INTO mod_timer (guild_id, user_id, event, created_at, userdata) '
-					'VALUES ($1, $2, $3, $4, $5)',
-					after.guild.id, after.id, 'MUTE', datetime.utcnow(), self._craft_user_data(after)
+				await MUTE_INSERT.execute(
+					self.db, after.guild.id, after.id, 'MUTE', datetime.utcnow(), self._craft_user_data(after)
 				)
 			except UniqueViolationError:
 				pass
 
 	@commands.Cog.listener()
 	async def on_member_join(self, member):
-		'''Check members at join for mute evasion'''
+		'''Check members at join for raids and mute evasion'''
 
 		conf = await self.config.get_entry(member.guild.id)
+
+		if conf.raid and not member.bot:
+			self.check_raid(conf, member)
+
 		mute_role_id = conf.mute_role_id
 
 		if mute_role_id is None:
 			return
 
 		# check if member was previously muted
-		_id = await self.db.fetchval(
-			'SELECT id FROM mod_timer WHERE guild_id=$1 AND user_id=$2 AND event=$3',
-			member.guild.id, member.id, 'MUTE'
-		)
+		_id = await TIMER_LOOKUP.fetchval(self.db, member.guild.id, member.id, 'MUTE')
 
 		if _id is None:
 			return
@@ -789,6 +1075,34 @@ class Moderation(AceMixin, commands.Cog):
 		await member.add_roles(mute_role, reason=reason)
 		self.bot.dispatch('log', member.guild, member, action='MUTE', severity=Severity.LOW, reason=reason)
 
+	def check_raid(self, conf, member):
+		if not conf.is_suspicious(member):
+			return
+
+		raid = self.raids.get(member.guild.id, None)
+
+		if raid is not None:
+			raid.add(member)
+			return
+
+		conf.recent_joins.append(member)
+
+		if conf.join_rate.add() < conf.raid_count:
+			return
+
+		log.info('Raid started in guild %s', member.guild.id)
+
+		raid = self.raids[member.guild.id] = Raid(self, conf)
+
+		# also punish the joins that started it, as far as they're within the window
+		now = datetime.utcnow()
+
+		while conf.recent_joins:
+			recent = conf.recent_joins.popleft()
+
+			if (now - recent.joined_at).total_seconds() <= conf.raid_per:
+				raid.add(recent)
+
 	@commands.command()
 	@commands.has_permissions(manage_messages=True)
 	@commands.bot_has_permissions(manage_messages=True)
@@ -1024,8 +1338,23 @@ class Moderation(AceMixin, commands.Cog):
 
 		await ctx.send(content)
 
-	async def do_action(self, message, action, reason, delete_message_days=0):
-		'''Called when an event happens.'''
+	def do_action(self, message, action, reason, delete_message_days=0, **fields):
+		'''Called when an event happens. Queues the action, extra fields are added to the log entry.'''
+
+		queue = self.punishments.get(message.guild.id, None)
+
+		if queue is None:
+			queue = self.punishments[message.guild.id] = PunishmentQueue(self, message.guild.id)
+
+		queue.add(message, action, reason, delete_message_days=delete_message_days, **fields)
+
+	async def punish(self, punishment):
+		'''Perform a queued action. Returns the notice to send in the channel of the message, if any.'''
+
+		message = punishment.message
+		action = punishment.action
+		reason = punishment.reason
+		fields = punishment.fields
 
 		member = message.author
 		guild = message.guild
@@ -1037,47 +1366,29 @@ class Moderation(AceMixin, commands.Cog):
 		if await ctx.is_mod():
 			self.bot.dispatch(
 				'log', guild, member, action='IGNORED {0} (MEMBER IS MOD)'.format(action.name), severity=Severity.LOW, message=message,
-				reason=reason,
+				reason=reason, **fields
 			)
 
-			return
+			return None
 
 		# otherwise, check against security actions and perform punishment
 		try:
-			if action is SecurityAction.MUTE:
-				mute_role = conf.mute_role
-
-				if mute_role is None:
-					raise ValueError('No mute role set.')
-
-				await member.add_roles(mute_role, reason=reason)
-
-			elif action is SecurityAction.KICK:
-				await member.kick(reason=reason)
-
-			elif action is SecurityAction.BAN:
-				await member.ban(delete_message_days=delete_message_days, reason=reason)
-
+			await apply_action(conf, member, action, reason, delete_message_days=punishment.delete_message_days)
 		except Exception as exc:
 			# log error if something happened
 			self.bot.dispatch(
 				'log', guild, member, action='{0} FAILED'.format(action.name), severity=Severity.HIGH, message=message,
-				reason=reason, error=str(exc)
+				reason=reason, error=str(exc), **fields
 			)
-			return
+			return None
 
 		# log successful security event
 		self.bot.dispatch(
 			'log', guild, member, action=action.name, severity=Severity(action.value), message=message,
-			reason=reason
+			reason=reason, **fields
 		)
 
-		try:
-			await message.channel.send('{0} {1}: {2}'.format(
-				po(member), SecurityVerb[action.name].value, reason
-			))
-		except discord.HTTPException:
-			pass
+		return '{0} {1}: {2}'.format(po(member), SecurityVerb[action.name].value, reason)
 
 	@commands.Cog.listener()
 	async def on_message(self, message):
@@ -1092,44 +1403,41 @@ class Moderation(AceMixin, commands.Cog):
 		if mc is None:
 			return
 
+		# the rate limiters update without awaiting, so concurrent messages can't interleave here
 		if mc.spam_action is not None:
-			# with a lock, figure out if user is spamming
-			async with SPAM_LOCK:
-				res = mc.spam_cooldown.update_rate_limit(message)
-				if res is not None:
-					mc.spam_cooldown._cache[mc.spam_cooldown._bucket_key(message)].reset()
+			# figure out if user is spamming
+			res = mc.spam_cooldown.hit(message.author.id)
 
 			# if so, perform the spam action
 			if res is not None:
-				await self.do_action(
+				mc.spam_cooldown.reset(message.author.id)
+				self.do_action(
 					message, SecurityAction[mc.spam_action], reason='Member is spamming'
 				)
 
-		if mc.mention_action is not None and message.mentions:
-			# same here. however run once for each mention
-			async with MENTION_LOCK:
-				for mention in message.mentions:
-					res = mc.mention_cooldown.update_rate_limit(message)
-					if res is not None:
-						mc.mention_cooldown._cache[mc.mention_cooldown._bucket_key(message)].reset()
-						break
-
-			if res is not None:
-				await self.do_action(
-					message, SecurityAction[mc.mention_action], reason='Member is mention spamming'
-				)
+		if mc.mention_action is not None:
+			# same here. however each mention costs a token, and role and everyone mentions more than one
+			cost = mc.mention_cost(message)
 
-		if message.guild.id == AHK_GUILD_ID:
-			async with CONTENT_LOCK:
-				res = mc.content_cooldown.update_rate_limit(message)
+			if cost:
+				res = mc.mention_cooldown.hit(message.author.id, cost=cost)
 
-				# since we're using the bucket key (guild_id, author_id, message_content)
-				# we can just as well reset the bucket after a ban
 				if res is not None:
-					mc.content_cooldown._cache[mc.content_cooldown._bucket_key(message)].reset()
+					mc.mention_cooldown.reset(message.author.id)
+					self.do_action(
+						message, SecurityAction[mc.mention_action], reason='Member is mention spamming',
+						mentions='{0} weighted mentions, {1:.1f} seconds before they would have been allowed'.format(cost, res)
+					)
+
+		if message.guild.id == AHK_GUILD_ID:
+			key = mc.content_cooldown.fingerprint(message.author.id, message.content)
+			res = mc.content_cooldown.hit(key, message.channel.id)
 
+			# since the bucket is keyed on the author and message content
+			# we can just as well reset the bucket after a ban
 			if res is not None:
-				await self.do_action(
+				mc.content_cooldown.reset(key)
+				self.do_action(
 					message, SecurityAction.BAN, reason='Member is spamming (with cleanup)', delete_message_days=1
 				)
 
@@ -1235,6 +1543,120 @@ class Moderation(AceMixin, commands.Cog):
 
 		await ctx.send(self._craft_string(ctx, 'mention', conf, now=True))
 
+	@mention.command(name='weights')
+	@is_mod()
+	async def mention_weights(self, ctx, role: weight_converter = None, everyone: weight_converter = None):
+		'''How many mentions a role mention and an `@everyone`/`@here` mention count as. Leave arguments blank to view the current weights.'''
+
+		conf = await self.config.get_entry(ctx.guild.id)
+
+		weights = dict()
+
+		if role is not None:
+			weights['mention_role_weight'] = role
+
+		if everyone is not None:
+			weights['mention_everyone_weight'] = everyone
+
+		if weights:
+			await conf.update(**weights)
+
+		await ctx.send(
+			'A role mention counts as `{0}` mentions and an everyone mention as `{1}` mentions.'.format(
+				conf.mention_role_weight, conf.mention_everyone_weight
+			)
+		)
+
+	def _craft_raid_string(self, ctx, conf):
+		filters = list()
+
+		if conf.raid_age is not None:
+			filters.append('accounts younger than `{0}`'.format(pretty_timedelta(conf.raid_age)))
+
+		if conf.raid_default_avatar:
+			filters.append('accounts with a default avatar')
+
+		data = (
+			'Raid mode {0} when `{1}` or more {2} join within `{3}` seconds.'
+		).format(
+			'starts' if conf.raid else 'would start', conf.raid_count,
+			' and '.join(filters) if filters else 'members', conf.raid_per
+		)
+
+		data += '\nDuring a raid, a `{0}` action is performed on every such member joining.'.format(conf.raid_action)
+
+		perms = ctx.perms
+
+		if conf.raid_action == 'MUTE' and conf.mute_role_id is None:
+			data += '\n\nNOTE: You do not have a mute role set up. Use `muterole <role>`!'
+		elif conf.raid_action == 'BAN' and not perms.ban_members:
+			data += '\n\nNOTE: I do not have Ban Members permissions!'
+		elif conf.raid_action == 'KICK' and not perms.kick_members:
+			data += '\n\nNOTE: I do not have Kick Members permissions!'
+		elif not conf.raid:
+			data += '\n\nNOTE: Anti-raid is disabled, enable by doing `raid action <action>`'
+		else:
+			data += '\n\nNo issues found with current configuration. Anti-raid is live!'
+
+		return data
+
+	@commands.group(invoke_without_command=True)
+	@is_mod()
+	async def raid(self, ctx):
+		'''View current anti-raid settings.'''
+
+		conf = await self.config.get_entry(ctx.guild.id)
+		await ctx.send(self._craft_raid_string(ctx, conf))
+
+	@raid.command(name='action')
+	@is_mod()
+	async def raid_action(self, ctx, *, action: ActionConverter = None):
+		'''Action taken towards members joining during a raid. Valid actions are `MUTE`, `KICK`, and `BAN`. Leave argument blank to disable anti-raid.'''
+
+		conf = await self.config.get_entry(ctx.guild.id)
+
+		if action is None:
+			await conf.update(raid=False)
+			await ctx.send('Anti-raid disabled.')
+		else:
+			await conf.update(raid=True, raid_action=action.name)
+			await ctx.send(self._craft_raid_string(ctx, conf))
+
+	@raid.command(name='rate')
+	@is_mod()
+	async def raid_rate(self, ctx, count: raid_count_converter, interval: raid_interval_converter):
+		'''Raid mode starts when `count` or more suspicious members join in `interval` seconds.'''
+
+		conf = await self.config.get_entry(ctx.guild.id)
+		await conf.update(raid_count=count, raid_per=interval)
+
+		conf.create_join_rate()
+
+		await ctx.send(self._craft_raid_string(ctx, conf))
+
+	@raid.command(name='age')
+	@is_mod()
+	async def raid_age(self, ctx, amount: TimeMultConverter = None, unit: TimeDeltaConverter = None):
+		'''Only count accounts younger than this as suspicious. Example: `raid age 3 days`. Leave arguments blank to count accounts of any age.'''
+
+		if amount is not None and unit is None:
+			raise commands.CommandError('Please specify a unit, like `raid age 3 days`.')
+
+		conf = await self.config.get_entry(ctx.guild.id)
+		await conf.update(raid_age=None if amount is None else amount * unit)
+
+		await ctx.send(self._craft_raid_string(ctx, conf))
+
+	@raid.command(name='avatar')
+	@is_mod()
+	async def raid_avatar(self, ctx, enabled: bool):
+		'''Whether to only count accounts with a default avatar as suspicious.'''
+
+		conf = await self.config.get_entry(ctx.guild.id)
+		await conf.update(raid_default_avatar=enabled)
+
+		await ctx.send(self._craft_raid_string(ctx, conf))
+
 	@commands.command(aliases=['pc'], hidden=True)
 	@is_mod()
 	@commands.bot_has_permissions(attach_files=True)
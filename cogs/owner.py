@@ -4,7 +4,6 @@ import io
 import logging
 import textwrap
 import traceback
-from collections import Counter
 from contextlib import redirect_stdout
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
@@ -90,7 +89,6 @@ class Owner(AceMixin, commands.Cog):
 		super().__init__(bot)
 
 		self.help_cog = bot.get_cog('AutoHotkeyHelpSystem')
-		self.event_counter = Counter()
 
 	async def cog_check(self, ctx):
 		return await self.bot.is_owner(ctx.author)
@@ -105,13 +103,6 @@ class Owner(AceMixin, commands.Cog):
 		# remove `foo`
 		return content.strip('` \n')
 
-	@commands.Cog.listener()
-	async def on_socket_response(self, msg):
-		t = msg['t']
-
-		if t is not None:
-			self.event_counter[t] += 1
-
 	@commands.command(hidden=True)
 	async def c(self, ctx, *, text):
 		await ctx.send(await self.help_cog.classify(text))
@@ -241,12 +232,77 @@ class Owner(AceMixin, commands.Cog):
 	async def gateway(self, ctx, *, n=None):
 		'''Print gateway event counters.'''
 
-		data = self.event_counter.most_common(n)
-		data = [(name, format(count, ',d')) for name, count in data]
+		events = self.bot.metrics.gateway_events.children.items()
+		data = sorted(((name, int(value.value)) for (name,), value in events), key=lambda item: item[1], reverse=True)
+		data = [(name, format(count, ',d')) for name, count in data[:n]]
 		headers = ('Event', 'Count')
 
 		await ctx.send('```{0}```'.format(tabulate(data, headers)))
 
+	@commands.command()
+	async def queries(self, ctx, n: int = 10):
+		'''Print the queries with the highest total time spent.'''
+
+		query_stats = self.bot.query_stats
+
+		def ms(seconds):
+			return '-' if seconds is None else format(seconds * 1000, '.1f')
+
+		data = list()
+
+		for stats in query_stats.top(n):
+			latency = stats.latency
+			data.append((
+				shorten(stats.template, 64), stats.calls, ms(stats.total_time), ms(latency.percentile(50)),
+				ms(latency.percentile(95)), ms(latency.percentile(99)), stats.rows, stats.errors
+			))
+
+		headers = ('Query', 'Calls', 'Total ms', 'p50', 'p95', 'p99', 'Rows', 'Errors')
+
+		table = tabulate(data, headers)
+		table += '\n\nPool wait p50/p95/p99: {0}/{1}/{2} ms. Slow queries: {3}'.format(
+			ms(query_stats.pool_wait.percentile(50)), ms(query_stats.pool_wait.percentile(95)),
+			ms(query_stats.pool_wait.percentile(99)), query_stats.slow_queries
+		)
+
+		if len(table) > 1994:
+			fp = io.BytesIO(table.encode('utf-8'))
+			await ctx.send('Too many results...', file=discord.File(fp, 'queries.txt'))
+		else:
+			await ctx.send('```' + table + '```')
+
+	@commands.command()
+	async def caches(self, ctx):
+		'''Print ConfigTable, starboard and anti-spam cache counters.'''
+
+		data = list()
+
+		for table in self.bot.config_tables:
+			stats = table.stats
+			data.append((
+				table.table, stats['entries'], stats['non_existent'], stats['hits'], stats['misses'], stats['evictions']
+			))
+
+		starboard = self.bot.get_cog('Starboard')
+		if starboard is not None:
+			stats = starboard.message_cache.stats
+			data.append(('star messages', stats['entries'], '-', stats['hits'], stats['misses'], stats['evictions']))
+
+			# a hit is a deleted message that had to be looked up, a miss a lookup skipped
+			stats = starboard.starred_ids.stats
+			data.append(('starred ids', stats['entries'], '-', stats['queried'], stats['skipped'], '-'))
+
+		moderation = self.bot.get_cog('Moderation')
+		if moderation is not None:
+			stats = [conf.content_cooldown.stats for conf in moderation.config.entries.values()]
+			data.append((
+				'content spam', sum(s['entries'] for s in stats), '-', '-', '-', sum(s['evictions'] for s in stats)
+			))
+
+		headers = ('Table', 'Entries', 'Absent', 'Hits', 'Misses', 'Evictions')
+
+		await ctx.send('```{0}```'.format(tabulate(data, headers)))
+
 	@commands.command()
 	async def test(self, ctx):
 		raise ValueError('test')
@@ -298,26 +354,6 @@ class Owner(AceMixin, commands.Cog):
 		else:
 			await ctx.send('Nothing to reload.')
 
-	@commands.command()
-	async def decache(self, ctx, guild_id: int):
-		'''Clear cache of table data of a specific guild.'''
-
-		configs = (
-			self.bot.config,
-			self.bot.get_cog('Starboard').config,
-			self.bot.get_cog('Moderation').config,
-			self.bot.get_cog('Welcome').config,
-			self.bot.get_cog('Roles').config,
-		)
-
-		cleared = []
-
-		for config in configs:
-			if await config.clear_entry(guild_id):
-				cleared.append(config)
-
-		await ctx.send('Cleared entries for:\n```\n{0}\n```'.format('\n'.join(config.table for config in cleared)))
-
 	@commands.command(aliases=['g'])
 	@commands.bot_has_permissions(embed_links=True)
 	async def google(self, ctx, *, query: str):
@@ -10,6 +10,7 @@ from cogs.mixins import AceMixin
 from utils.converters import SerialConverter
 from utils.databasetimer import ColumnTimer
 from utils.pager import Pager
+from utils.queries import register
 from utils.string import po, shorten
 from utils.time import pretty_datetime, pretty_timedelta
 
@@ -21,6 +22,15 @@ MIN_DELTA = timedelta(minutes=1)
 MAX_DELTA = timedelta(days=365 * 10)
 MAX_REMINDERS = 32
 
+REMIND_COUNT = register('remind.count', 'SELECT COUNT(id) FROM remind WHERE user_id=$1')
+REMIND_INSERT = register(
+	'remind.insert',
+	'INSERT INTO remind (guild_id, channel_id, user_id, message_id, made_on, remind_on, message) '
+	'VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *'
+)
+REMIND_LIST = register('remind.list', 'SELECT * FROM remind WHERE guild_id=$1 AND user_id=$2 ORDER BY id DESC')
+REMIND_DELETE = register('remind.delete', 'DELETE FROM remind WHERE id=$1 AND guild_id=$2 AND user_id=$3')
+
 
 class RemindPager(Pager):
 	async def craft_page(self, e, page, entries):
@@ -138,10 +148,11 @@ class Reminders(AceMixin, commands.Cog):
 		e.set_footer(text=f'#{channel.name}')
 
 		try:
-			if channel is not None:
-				await channel.send(content=f'<@{user_id}>', embed=e)
-			elif user is not None:
-				await user.send(embed=e)
+			async with self.timer.limit:
+				if channel is not None:
+					await channel.send(content=f'<@{user_id}>', embed=e)
+				elif user is not None:
+					await user.send(embed=e)
 		except discord.HTTPException as exc:
 			log.info('Failed sending reminder #%s for %s - %s', _id, po(user), str(exc))
 
@@ -161,16 +172,15 @@ class Reminders(AceMixin, commands.Cog):
 		if message is not None and len(message) > 1024:
 			raise commands.CommandError('Sorry, keep the message below 1024 characters!')
 
-		count = await self.db.fetchval('SELECT COUNT(id) FROM remind WHERE user_id=$1', ctx.author.id)
+		count = await REMIND_COUNT.fetchval(self.db, ctx.author.id)
 		if count > MAX_REMINDERS:
 			raise commands.CommandError(f'Sorry, you can\'t have more than {MAX_REMINDERS} active reminders at once.')
 
-		await self.db.execute(
-			'INSERT INTO remind (guild_id, channel_id, user_id, message_id, made_on, remind_on, message) VALUES ($1, $2, $3, $4, $5, $6, $7)',
-			ctx.guild.id, ctx.channel.id, ctx.author.id, ctx.message.id, now, when, message
+		record = await REMIND_INSERT.fetchrow(
+			self.db, ctx.guild.id, ctx.channel.id, ctx.author.id, ctx.message.id, now, when, message
 		)
 
-		self.timer.maybe_restart(when)
+		self.timer.add(record)
 
 		remind_in = when - now
 		remind_in += timedelta(microseconds=1000000 - (remind_in.microseconds % 1000000))
@@ -184,10 +194,7 @@ class Reminders(AceMixin, commands.Cog):
 	async def reminders(self, ctx):
 		'''List your reminders in this guild.'''
 
-		res = await self.db.fetch(
-			'SELECT * FROM remind WHERE guild_id=$1 AND user_id=$2 ORDER BY id DESC',
-			ctx.guild.id, ctx.author.id
-		)
+		res = await REMIND_LIST.fetch(self.db, ctx.guild.id, ctx.author.id)
 
 		if not len(res):
 			raise commands.CommandError('Couldn\'t find any reminders.')
@@ -199,14 +206,11 @@ class Reminders(AceMixin, commands.Cog):
 	async def delreminder(self, ctx, *, reminder_id: SerialConverter()):
 		'''Delete a reminder. Must be your own reminder.'''
 
-		res = await self.db.execute(
-			'DELETE FROM remind WHERE id=$1 AND guild_id=$2 AND user_id=$3',
-			reminder_id, ctx.guild.id, ctx.author.id
-		)
+		res = await REMIND_DELETE.execute(self.db, reminder_id, ctx.guild.id, ctx.author.id)
 
 		if res == 'DELETE 1':
 			await ctx.send('Reminder deleted.')
-			self.timer.restart_if(lambda record: record.get('id') == reminder_id)
+			self.timer.remove_if(lambda record: record.get('id') == reminder_id)
 		else:
 			raise commands.CommandError('Reminder not found, or you do not own it.')
 
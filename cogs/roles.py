@@ -8,10 +8,16 @@ from cogs.mixins import AceMixin
 from utils.configtable import ConfigTable
 from utils.context import can_prompt
 from utils.converters import EmojiConverter, MaxLengthConverter
+from utils.queries import register
 from utils.string import po, shorten
 
 log = logging.getLogger(__name__)
 
+SELECTOR_LOOKUP = register('role_selector.lookup', 'SELECT * FROM role_selector WHERE id=$1')
+ROLE_BY_EMOJI = register(
+	'role_entry.by_emoji', 'SELECT * FROM role_entry WHERE emoji=$1 AND id=ANY($2::INTEGER[])'
+)
+
 FOOTER_TEXT = 'Click a reaction to add/remove roles.'
 RERUN_PROMPT = 'Re-run `roles spawn` for changes to take effect.'
 
@@ -854,14 +860,11 @@ class Roles(AceMixin, commands.Cog):
 
 		selector_id = conf.selectors[conf.message_ids.index(message_id)]
 
-		selector = await self.db.fetchrow('SELECT * FROM role_selector WHERE id=$1', selector_id)
+		selector = await SELECTOR_LOOKUP.fetchrow(self.db, selector_id)
 		if selector is None:
 			return
 
-		role_row = await self.db.fetchrow(
-			'SELECT * FROM role_entry WHERE emoji=$1 AND id=ANY($2::INTEGER[])',
-			str(emoji), selector.get('roles')
-		)
+		role_row = await ROLE_BY_EMOJI.fetchrow(self.db, str(emoji), selector.get('roles'))
 
 		if role_row is None:
 			return
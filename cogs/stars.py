@@ -1,14 +1,18 @@
+import asyncio
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from time import monotonic
 
 import discord
-from asyncpg.exceptions import UniqueViolationError
 from discord.ext import commands, tasks
 
 from cogs.mixins import AceMixin
+from utils.bloomfilter import BloomFilter
 from utils.configtable import ConfigTable, ConfigTableRecord
 from utils.context import can_prompt, is_mod
 from utils.converters import param_name
+from utils.queries import register
 from utils.string import yesno
 
 log = logging.getLogger(__name__)
@@ -16,6 +20,19 @@ STAR_EMOJI = '\N{WHITE MEDIUM STAR}'
 STAR_COOLDOWN = timedelta(minutes=3)
 STAR_CUTOFF = timedelta(days=7)
 
+# at most one edit of a starboard message per this many seconds
+STAR_EDIT_INTERVAL = 10.0
+
+# discord refuses to bulk delete messages older than 14 days. a day of margin, since the whole
+# request fails if a single message crosses that line before it arrives
+BULK_DELETE_CUTOFF = timedelta(days=13)
+
+# amount of fetched messages kept around for star reactions
+MESSAGE_CACHE_SIZE = 1024
+
+# guilds with more starred IDs than this keep them in a Bloom filter instead of a set
+STARRED_IDS_BLOOM_THRESHOLD = 50000
+
 SB_NOT_EXIST_ERROR = commands.CommandError('Please set up a starboard using `star create` first.')
 SB_NOT_SET_ERROR = commands.CommandError('No starboard channel has been set yet.')
 SB_NOT_FOUND_ERROR = commands.CommandError('Starboard channel set but not found. Please create a new one.')
@@ -24,6 +41,41 @@ SB_ORIG_MSG_NOT_FOUND_ERROR = commands.CommandError('Could not find original mes
 SB_STAR_MSG_NOT_FOUND_ERROR = commands.CommandError('Could not find starred message.')
 SB_NOT_POSTED = commands.CommandError('Star not posted yet.')
 
+STAR_LOOKUP = register(
+	'star.lookup', 'SELECT * FROM star_msg WHERE guild_id=$1 AND (message_id=$2 OR star_message_id=$2)'
+)
+STAR_LOOKUP_DELETED = register(
+	'star.lookup_deleted', 'SELECT * FROM star_msg WHERE message_id=$1 OR star_message_id=$1'
+)
+STAR_INSERT = register(
+	'star.insert',
+	'INSERT INTO star_msg (guild_id, channel_id, user_id, message_id, star_message_id, starred_at, '
+	'starrer_id) VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id'
+)
+STAR_SET_MESSAGE = register('star.set_message', 'UPDATE star_msg SET star_message_id=$1 WHERE id=$2')
+STAR_DELETE = register('star.delete', 'DELETE FROM star_msg WHERE id=$1')
+
+# star_count is the total amount of stars, which is the original starrer plus everyone in starrers.
+# these keep it up to date in the same statement that adds or removes the starrer, and return the
+# new count, or nothing if the starrer was already there/wasn't there
+STARRER_INSERT = register(
+	'starrer.insert',
+	'WITH starrer AS (INSERT INTO starrers (star_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING star_id) '
+	'UPDATE star_msg SET star_count = star_count + 1 FROM starrer WHERE star_msg.id = starrer.star_id '
+	'RETURNING star_count'
+)
+STARRER_DELETE = register(
+	'starrer.delete',
+	'WITH starrer AS (DELETE FROM starrers WHERE star_id=$1 AND user_id=$2 RETURNING star_id) '
+	'UPDATE star_msg SET star_count = star_count - 1 FROM starrer WHERE star_msg.id = starrer.star_id '
+	'RETURNING star_count'
+)
+STAR_RECOUNT = register(
+	'star.recount',
+	'UPDATE star_msg SET star_count = 1 + (SELECT COUNT(*) FROM starrers WHERE star_id=$1) WHERE id=$1 '
+	'RETURNING star_count'
+)
+
 
 class StarboardConfigRecord(ConfigTableRecord):
 	@property
@@ -38,6 +90,326 @@ class StarboardConfigRecord(ConfigTableRecord):
 		return guild.get_channel(self.channel_id)
 
 
+class StarEditCoalescer:
+	'''Coalesces star count edits of starboard messages.
+
+	Each starboard message is edited at most once per `interval` seconds. Star count changes
+	that come in while an edit is waiting only replace the count it will be made with, so a burst
+	of stars ends up as one edit with the final count.
+	'''
+
+	def __init__(self, cog, interval=STAR_EDIT_INTERVAL):
+		self.cog = cog
+		self.interval = interval
+
+		self.pending = dict()
+		self.tasks = dict()
+		self.last_edit = dict()
+
+	def schedule(self, message_id, star_message, stars):
+		key = star_message.id
+		self.pending[key] = (message_id, star_message, stars)
+
+		# the waiting edit will use the new count
+		if key in self.tasks:
+			return
+
+		now = monotonic()
+		last_edit = self.last_edit.get(key, None)
+		delay = 0.0 if last_edit is None else max(0.0, last_edit + self.interval - now)
+
+		self.tasks[key] = self.cog.bot.loop.create_task(self._edit_later(key, delay))
+
+		if len(self.last_edit) > 1024:
+			self.last_edit = {k: v for k, v in self.last_edit.items() if now - v < self.interval}
+
+	async def _edit_later(self, key, delay):
+		if delay:
+			await asyncio.sleep(delay)
+
+		self.tasks.pop(key, None)
+		await self._edit(key)
+
+	async def _edit(self, key):
+		entry = self.pending.pop(key, None)
+		if entry is None:
+			return
+
+		self.last_edit[key] = monotonic()
+		message_id, star_message, stars = entry
+
+		try:
+			await self.cog.update_star(message_id, star_message, stars)
+		except discord.HTTPException as exc:
+			log.warning('Failed editing star message %s: %s', key, str(exc))
+
+	async def flush(self):
+		'''Make all waiting edits right away.'''
+
+		for task in self.tasks.values():
+			task.cancel()
+
+		self.tasks.clear()
+
+		await asyncio.gather(*(self._edit(key) for key in list(self.pending)))
+
+
+class MessageCache:
+	'''LRU of messages fetched over REST, keyed by message ID.
+
+	Lookups that miss fall back to discord.py's own message cache before going to REST. Entries
+	are dropped when the message is edited or deleted, so a cached message is never older than
+	the last change to it.
+	'''
+
+	def __init__(self, bot, max_size=MESSAGE_CACHE_SIZE):
+		self.bot = bot
+		self.max_size = max_size
+		self.messages = OrderedDict()
+
+		# hits are REST calls avoided
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	async def fetch(self, channel, message_id):
+		message = self.messages.get(message_id, None)
+
+		if message is not None:
+			self.messages.move_to_end(message_id)
+		else:
+			# discord.py's cache is a linear scan over the last messages received, so it comes second
+			message = self.bot._connection._get_message(message_id)
+
+		if message is not None:
+			self.hits += 1
+			return message
+
+		message = await channel.fetch_message(message_id)
+		self.misses += 1
+
+		self.messages[message_id] = message
+
+		if len(self.messages) > self.max_size:
+			self.messages.popitem(last=False)
+			self.evictions += 1
+
+		return message
+
+	def invalidate(self, *message_ids):
+		for message_id in message_ids:
+			self.messages.pop(message_id, None)
+
+	@property
+	def stats(self):
+		return dict(entries=len(self.messages), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class StarCooldowns:
+	'''When each member last starred a new message in each guild, for enforcing the star cooldown.
+
+	Only stars within the cooldown matter, so entries are dropped once they're older than that.
+	The map is kept in the order stars happened, which makes expiring it a matter of popping
+	from the front. `loaded` is set once the stars from before startup are in.
+	'''
+
+	def __init__(self, cooldown=STAR_COOLDOWN):
+		self.cooldown = cooldown
+		self.last_starred = OrderedDict()
+		self.loaded = asyncio.Event()
+
+	def _expire(self, now):
+		pivot = now - self.cooldown
+
+		while self.last_starred:
+			if next(iter(self.last_starred.values())) > pivot:
+				break
+
+			self.last_starred.popitem(last=False)
+
+	def on_cooldown(self, guild_id, starrer_id):
+		now = datetime.utcnow()
+		self._expire(now)
+
+		return (guild_id, starrer_id) in self.last_starred
+
+	def starred(self, guild_id, starrer_id, starred_at):
+		key = (guild_id, starrer_id)
+
+		self.last_starred.pop(key, None)
+		self.last_starred[key] = starred_at
+
+	async def load(self, db):
+		'''Fill the map with the stars still within the cooldown.'''
+
+		try:
+			rows = await db.fetch(
+				'SELECT guild_id, starrer_id, MAX(starred_at) AS starred_at FROM star_msg WHERE starred_at > $1 '
+				'GROUP BY guild_id, starrer_id ORDER BY MAX(starred_at)',
+				datetime.utcnow() - self.cooldown
+			)
+		except Exception:
+			# don't hold up starring forever, only stars from here on will be on cooldown
+			log.exception('Failed loading star cooldowns')
+			self.loaded.set()
+			return
+
+		for row in rows:
+			self.starred(row.get('guild_id'), row.get('starrer_id'), row.get('starred_at'))
+
+		self.loaded.set()
+
+
+class StarredIds:
+	'''Starred message IDs and starboard message IDs per guild, for skipping star lookups of deleted messages.
+
+	Guilds keep their IDs in a set, or in a Bloom filter once they have more than `threshold`.
+	Bloom filters can't forget IDs, so deleted stars show up as possible hits until the filter
+	fills up and is rebuilt from the database. Until the IDs are loaded, and while a guild is
+	rebuilt, every message might be starred.
+	'''
+
+	def __init__(self, bot, threshold=STARRED_IDS_BLOOM_THRESHOLD):
+		self.bot = bot
+		self.threshold = threshold
+
+		self.ids = dict()
+		self.loaded = False
+
+		# guilds being rebuilt, and the IDs added to them since the rebuild started
+		self.rebuilding = dict()
+
+		# skipped are lookups avoided
+		self.skipped = 0
+		self.queried = 0
+
+	def _might_contain(self, guild_id, message_id):
+		if not self.loaded or guild_id in self.rebuilding:
+			return True
+
+		ids = self.ids.get(guild_id, None)
+		return ids is not None and message_id in ids
+
+	def might_contain(self, guild_id, message_id):
+		if self._might_contain(guild_id, message_id):
+			self.queried += 1
+			return True
+
+		self.skipped += 1
+		return False
+
+	def filter(self, guild_id, message_ids):
+		'''The IDs out of `message_ids` that might be starred.'''
+
+		possible = [message_id for message_id in message_ids if self._might_contain(guild_id, message_id)]
+
+		if possible:
+			self.queried += 1
+		else:
+			self.skipped += 1
+
+		return possible
+
+	def _store(self, guild_id, message_ids):
+		if len(message_ids) > self.threshold:
+			ids = BloomFilter(capacity=len(message_ids) * 2)
+			for message_id in message_ids:
+				ids.add(message_id)
+		else:
+			ids = set(message_ids)
+
+		self.ids[guild_id] = ids
+
+	def add(self, guild_id, *message_ids):
+		ids = self.ids.get(guild_id, None)
+
+		if ids is None:
+			ids = self.ids[guild_id] = set()
+
+		added = self.rebuilding.get(guild_id, None)
+
+		for message_id in message_ids:
+			if message_id is not None:
+				ids.add(message_id)
+
+				if added is not None:
+					added.append(message_id)
+
+		if isinstance(ids, BloomFilter):
+			if len(ids) > ids.capacity and guild_id not in self.rebuilding:
+				self.rebuilding[guild_id] = list()
+				self.bot.loop.create_task(self._rebuild(guild_id))
+		elif len(ids) > self.threshold:
+			self._store(guild_id, ids)
+
+	def remove(self, guild_id, *message_ids):
+		ids = self.ids.get(guild_id, None)
+
+		if isinstance(ids, set):
+			for message_id in message_ids:
+				ids.discard(message_id)
+
+	def clear(self, guild_id):
+		self.ids.pop(guild_id, None)
+
+	async def _fetch(self, guild_id=None):
+		query = 'SELECT guild_id, message_id, star_message_id FROM star_msg'
+
+		if guild_id is None:
+			rows = await self.bot.db.fetch(query)
+		else:
+			rows = await self.bot.db.fetch(query + ' WHERE guild_id=$1', guild_id)
+
+		by_guild = dict()
+
+		for row in rows:
+			ids = by_guild.setdefault(row.get('guild_id'), list())
+			ids.append(row.get('message_id'))
+
+			if row.get('star_message_id') is not None:
+				ids.append(row.get('star_message_id'))
+
+		return by_guild
+
+	async def load(self):
+		'''Load the IDs of every guild.'''
+
+		by_guild = await self._fetch()
+
+		for guild_id, message_ids in by_guild.items():
+			# keep anything starred while the query ran
+			added = self.ids.get(guild_id, None)
+			if added:
+				message_ids.extend(added)
+
+			self._store(guild_id, message_ids)
+
+		self.loaded = True
+
+		log.info('Loaded %s starred message IDs of %s guilds', sum(len(ids) for ids in self.ids.values()), len(self.ids))
+
+	async def _rebuild(self, guild_id):
+		try:
+			by_guild = await self._fetch(guild_id)
+		except Exception:
+			# stays in rebuilding, so the guild always gets looked up
+			log.exception('Failed rebuilding starred message IDs of guild %s', guild_id)
+			return
+
+		# stars committed after the query's snapshot only made it into the old filter, keep them
+		message_ids = by_guild.get(guild_id, list())
+		message_ids.extend(self.rebuilding.pop(guild_id))
+
+		self._store(guild_id, message_ids)
+
+	@property
+	def stats(self):
+		return dict(
+			entries=sum(len(ids) for ids in self.ids.values()), queried=self.queried, skipped=self.skipped,
+			bloom_guilds=sum(1 for ids in self.ids.values() if isinstance(ids, BloomFilter))
+		)
+
+
 class StarConverter(commands.MessageConverter, commands.IDConverter):
 	async def convert(self, ctx, argument):
 		try:
@@ -50,10 +422,7 @@ class StarConverter(commands.MessageConverter, commands.IDConverter):
 				name = param_name(self, ctx)
 				raise commands.BadArgument(f'{name} doesn\'t seem to be a message or message id.')
 
-		row = await ctx.bot.db.fetchrow(
-			'SELECT * FROM star_msg WHERE guild_id=$1 AND (message_id=$2 OR star_message_id=$2)',
-			ctx.guild.id, _id
-		)
+		row = await STAR_LOOKUP.fetchrow(ctx.bot.db, ctx.guild.id, _id)
 
 		if row is None:
 			name = param_name(self, ctx)
@@ -74,51 +443,98 @@ class Starboard(AceMixin, commands.Cog):
 		super().__init__(bot)
 
 		self.config = ConfigTable(bot, table='starboard', primary='guild_id', record_class=StarboardConfigRecord)
-
-		self.purge_query = '''
-			SELECT id, guild_id, channel_id, star_message_id
-			FROM star_msg
-			WHERE guild_id = $1
-			AND starred_at < $2
-			AND (SELECT COUNT(id) FROM starrers WHERE starrers.star_id=star_msg.id) < $3
-		'''
+		self.star_edits = StarEditCoalescer(self)
+		self.message_cache = MessageCache(bot)
+		self.cooldowns = StarCooldowns()
+		self.starred_ids = StarredIds(bot)
 
 		self.purger.start()
+		self.bot.loop.create_task(self.cooldowns.load(self.db))
+		self.bot.loop.create_task(self.starred_ids.load())
+
+	def cog_unload(self):
+		self.purger.cancel()
+		self.bot.loop.create_task(self.star_edits.flush())
+
+	async def cog_close(self):
+		await self.star_edits.flush()
 
 	@tasks.loop(minutes=20)
 	async def purger(self):
 		'''Purges old and underperforming stars depending on guild starboard settings.'''
 
-		boards = await self.db.fetch(
-			'SELECT guild_id, channel_id, threshold FROM starboard WHERE locked IS FALSE AND threshold IS NOT NULL'
+		rows = await self.db.fetch(
+			'''
+			SELECT star_msg.id, star_msg.guild_id, star_msg.message_id, star_msg.star_message_id,
+			starboard.channel_id AS board_channel_id
+			FROM star_msg
+			JOIN starboard USING (guild_id)
+			WHERE starboard.locked IS FALSE
+			AND starboard.threshold IS NOT NULL
+			AND star_msg.starred_at < $1
+			AND star_msg.star_count < starboard.threshold
+			''',
+			datetime.utcnow() - STAR_CUTOFF
 		)
 
-		pivot = datetime.utcnow() - STAR_CUTOFF
 		to_delete = list()
+		by_channel = dict()
 
-		for board in boards:
-			rows = await self.db.fetch(
-				self.purge_query, board.get('guild_id'), pivot, board.get('threshold') - 1
-			)
-
-			if not rows:
-				continue
-
-			star_channel = self.bot.get_channel(board.get('channel_id'))
+		for row in rows:
+			# starboards this process can't see are left to whichever process can
+			star_channel = self.bot.get_channel(row.get('board_channel_id'))
 			if star_channel is None:
 				continue
 
-			for row in rows:
-				to_delete.append(row.get('id'))
+			to_delete.append(row)
 
-				try:
-					star_message = await star_channel.fetch_message(row.get('star_message_id'))
-					await star_message.delete()
-				except discord.HTTPException:
-					continue
+			if row.get('star_message_id') is not None:
+				by_channel.setdefault(star_channel, list()).append(row.get('star_message_id'))
+
+		if not to_delete:
+			return
+
+		calls = 0
+		for star_channel, message_ids in by_channel.items():
+			calls += await self.delete_star_messages(star_channel, message_ids)
 
-		if to_delete:
-			await self.db.execute('DELETE FROM star_msg WHERE id=ANY($1::bigint[])', to_delete)
+		await self.db.execute('DELETE FROM star_msg WHERE id=ANY($1::integer[])', [row.get('id') for row in to_delete])
+
+		for row in to_delete:
+			self.starred_ids.remove(row.get('guild_id'), row.get('message_id'), row.get('star_message_id'))
+
+		log.info('Purged %s stars from %s starboards with %s API calls', len(to_delete), len(by_channel), calls)
+
+	async def delete_star_messages(self, star_channel, message_ids):
+		'''Delete starboard messages by ID without fetching them first. Returns the amount of API calls made.'''
+
+		bulk_after = datetime.utcnow() - BULK_DELETE_CUTOFF
+
+		bulk = [_id for _id in message_ids if discord.utils.snowflake_time(_id) > bulk_after]
+		single = [_id for _id in message_ids if discord.utils.snowflake_time(_id) <= bulk_after]
+
+		calls = 0
+
+		for idx in range(0, len(bulk), 100):
+			chunk = bulk[idx:idx + 100]
+			calls += 1
+
+			try:
+				await star_channel.delete_messages([star_channel.get_partial_message(_id) for _id in chunk])
+			except discord.HTTPException as exc:
+				# the rows are deleted either way, so don't leave the messages behind untracked
+				log.info('Bulk deleting %s star messages failed, deleting one by one: %s', len(chunk), str(exc))
+				single.extend(chunk)
+
+		for _id in single:
+			calls += 1
+
+			try:
+				await star_channel.get_partial_message(_id).delete()
+			except discord.HTTPException:
+				pass
+
+		return calls
 
 	async def get_board(self, guild_id, raise_on_locked=True):
 		board = await self.config.get_entry(guild_id, construct=False)
@@ -162,6 +578,7 @@ class Starboard(AceMixin, commands.Cog):
 				raise commands.CommandError('Aborted starboard creation.')
 
 		await self.db.execute('DELETE FROM star_msg WHERE guild_id=$1', ctx.guild.id)
+		self.starred_ids.clear(ctx.guild.id)
 
 		overwrites = {
 			ctx.me: discord.PermissionOverwrite(
@@ -290,10 +707,8 @@ class Starboard(AceMixin, commands.Cog):
 
 		row = message
 
-		star_ret = await self.db.fetchval('SELECT COUNT(id) FROM starrers WHERE star_id=$1', row.get('id'))
-
 		author = await ctx.guild.fetch_member(row.get('user_id'))
-		stars = star_ret + 1
+		stars = row.get('star_count')
 
 		e = discord.Embed()
 		e.set_author(name=author.display_name, icon_url=author.avatar_url)
@@ -394,24 +809,18 @@ class Starboard(AceMixin, commands.Cog):
 				if user.id == row.get('starrer_id'):
 					continue
 
-				try:
-					await self.db.execute(
-						'INSERT INTO starrers (star_id, user_id) VALUES ($1, $2)',
-						row.get('id'), user.id
-					)
-
+				if await STARRER_INSERT.fetchval(self.db, row.get('id'), user.id) is not None:
 					added += 1
-				except UniqueViolationError:
-					pass
 
-		star_count = await self.db.fetchval('SELECT COUNT(*) FROM starrers WHERE star_id=$1', row.get('id'))
+		# count from scratch, in case the stored count drifted
+		star_count = await STAR_RECOUNT.fetchval(self.db, row.get('id'))
 
-		new_embed = self.get_embed(message, star_count + 1)
+		new_embed = self.get_embed(message, star_count)
 		edited = new_embed.description != star_message.embeds[0].description
 
 		await star_message.edit(
-			content=self.get_header(message.id, star_count + 1),
-			embed=self.get_embed(message, star_count + 1)
+			content=self.get_header(message.id, star_count),
+			embed=self.get_embed(message, star_count)
 		)
 
 		parts = list()
@@ -448,7 +857,8 @@ class Starboard(AceMixin, commands.Cog):
 
 		# delete from the star messages table
 		# cascades into starrers table as well
-		await self.db.execute('DELETE FROM star_msg WHERE id=$1', row.get('id'))
+		await STAR_DELETE.execute(self.db, row.get('id'))
+		self.starred_ids.remove(ctx.guild.id, row.get('message_id'), row.get('star_message_id'))
 
 		star_message_id = row.get('star_message_id')
 
@@ -493,13 +903,10 @@ class Starboard(AceMixin, commands.Cog):
 			if not len(message.content) and not len(message.attachments):
 				raise commands.CommandError('Can\'t star this message because it has no embeddable content.')
 
-			# make sure the starrer isn't starring too quickly
-			prev_time = await self.db.fetchval(
-				'SELECT starred_at FROM star_msg WHERE guild_id=$1 AND starrer_id=$2 ORDER BY id DESC LIMIT 1',
-				message.guild.id, starrer.id
-			)
+			# make sure the starrer isn't starring too quickly, which needs the stars from before startup
+			await self.cooldowns.loaded.wait()
 
-			if prev_time is not None and datetime.utcnow() - prev_time < STAR_COOLDOWN:
+			if self.cooldowns.on_cooldown(message.guild.id, starrer.id):
 				raise commands.CommandError('Please wait a bit before starring again.')
 
 			# post it if no minimum star requirement is set
@@ -509,13 +916,17 @@ class Starboard(AceMixin, commands.Cog):
 			else:
 				star_message_id = None
 
-			await self.db.execute(
-				'INSERT INTO star_msg (guild_id, channel_id, user_id, message_id, star_message_id, starred_at, '
-				'starrer_id) VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id',
-				message.guild.id, message.channel.id, message.author.id, message.id, star_message_id,
-				datetime.utcnow(), starrer.id
+			starred_at = datetime.utcnow()
+
+			await STAR_INSERT.execute(
+				self.db, message.guild.id, message.channel.id, message.author.id, message.id, star_message_id,
+				starred_at, starrer.id
 			)
 
+			self.starred_ids.add(message.guild.id, message.id, star_message_id)
+
+			self.cooldowns.starred(message.guild.id, starrer.id, starred_at)
+
 			# add the star emoji reaction to the starboard message if posted
 			if star_message_id is not None:
 				try:
@@ -534,57 +945,39 @@ class Starboard(AceMixin, commands.Cog):
 			if starrer.id == record.get('user_id'):
 				raise commands.CommandError('Message authors can\'t star their own message.')
 
-			try:
-				await self.db.execute(
-					'INSERT INTO starrers (star_id, user_id) VALUES ($1, $2)',
-					record.get('id'), starrer.id
-				)
-			except UniqueViolationError:
-				return
+			star_count = await STARRER_INSERT.fetchval(self.db, record.get('id'), starrer.id)
 
-			starrer_count = await self.db.fetchval(
-				'SELECT COUNT(*) FROM starrers WHERE star_id=$1',
-				record.get('id')
-			)
+			# already starred by this member
+			if star_count is None:
+				return
 
 			if star_message is not None:
 				# update star if star_message exists
-				await self.update_star(record.get('message_id'), star_message, starrer_count + 1)
+				self.star_edits.schedule(record.get('message_id'), star_message, star_count)
 
-			elif board.minimum is None or board.minimum <= starrer_count:
-				# post star if minimum is now None, or <= starrer_count
-				star_message = await self.post_star(star_channel, message, starrer_count + 1)
-				await self.db.execute('UPDATE star_msg SET star_message_id=$1 WHERE id=$2', star_message.id, record.get('id'))
+			elif board.minimum is None or board.minimum < star_count:
+				# post star if minimum is now None, or the starrers besides the original starrer reach it
+				star_message = await self.post_star(star_channel, message, star_count)
+				await STAR_SET_MESSAGE.execute(self.db, star_message.id, record.get('id'))
+				self.starred_ids.add(message.guild.id, star_message.id)
 
 	async def _on_unstar(self, board, starrer, star_channel, message, star_message, record):
 		if record:
-			result = await self.db.execute(
-				'DELETE FROM starrers WHERE star_id=$1 AND user_id=$2',
-				record.get('id'), starrer.id
-			)
+			star_count = await STARRER_DELETE.fetchval(self.db, record.get('id'), starrer.id)
 
 			# if nothing was deleted, the star message doesn't need to be updated
-			if result == 'DELETE 0':
+			if star_count is None:
 				raise commands.CommandError('You have not previously starred this, or you are the original starrer.')
 
-			# otherwise we need to update the star count
-			starrer_count = await self.db.fetchval(
-				'SELECT COUNT(*) FROM starrers WHERE star_id=$1',
-				record.get('id')
-			)
-
 			if star_message is not None:
-				await self.update_star(record.get('message_id'), star_message, starrer_count + 1)
+				self.star_edits.schedule(record.get('message_id'), star_message, star_count)
 
 		else:
 			raise commands.CommandError('This message has not previously been starred.')
 
 	async def _on_star_event_meta(self, event, board, message, starrer):
 		# get the starmessage record if it exists
-		row = await self.db.fetchrow(
-			'SELECT * FROM star_msg WHERE guild_id=$1 AND (message_id=$2 OR star_message_id=$2)',
-			message.guild.id, message.id
-		)
+		row = await STAR_LOOKUP.fetchrow(self.db, message.guild.id, message.id)
 
 		if message.channel.id == board.channel_id:
 			# if it's from the starboard itself, it *has* to be a message from ourself
@@ -610,7 +1003,7 @@ class Starboard(AceMixin, commands.Cog):
 			else:
 				# if we have the record we catch fetch the starred message
 				try:
-					star_message = await star_channel.fetch_message(star_message_id)
+					star_message = await self.message_cache.fetch(star_channel, star_message_id)
 				except discord.HTTPException:
 					raise SB_STAR_MSG_NOT_FOUND_ERROR
 
@@ -653,7 +1046,7 @@ class Starboard(AceMixin, commands.Cog):
 			return
 
 		try:
-			message = await channel.fetch_message(payload.message_id)
+			message = await self.message_cache.fetch(channel, payload.message_id)
 		except discord.HTTPException:
 			return
 
@@ -700,8 +1093,14 @@ class Starboard(AceMixin, commands.Cog):
 	async def on_raw_reaction_remove(self, payload):
 		await self._on_star_event(payload, self._on_unstar)
 
+	@commands.Cog.listener()
+	async def on_raw_message_edit(self, payload):
+		self.message_cache.invalidate(payload.message_id)
+
 	@commands.Cog.listener()
 	async def on_raw_message_delete(self, payload):
+		self.message_cache.invalidate(payload.message_id)
+
 		if payload.guild_id is None:
 			return
 
@@ -710,17 +1109,19 @@ class Starboard(AceMixin, commands.Cog):
 		if board is None or board.locked:
 			return
 
+		# most deleted messages were never starred, only look them up if they might have been
+		if not self.starred_ids.might_contain(payload.guild_id, payload.message_id):
+			return
+
 		# see if the deleted message is stored in the database as a starred message
-		row = await self.db.fetchrow(
-			'SELECT * FROM star_msg WHERE message_id=$1 OR star_message_id=$1',
-			payload.message_id
-		)
+		row = await STAR_LOOKUP_DELETED.fetchrow(self.db, payload.message_id)
 
 		if row is None:
 			return
 
 		# delete from db
-		await self.db.execute('DELETE FROM star_msg WHERE id=$1', row.get('id'))
+		await STAR_DELETE.execute(self.db, row.get('id'))
+		self.starred_ids.remove(payload.guild_id, row.get('message_id'), row.get('star_message_id'))
 
 		star_message_id = row.get('star_message_id')
 
@@ -756,6 +1157,8 @@ class Starboard(AceMixin, commands.Cog):
 
 	@commands.Cog.listener()
 	async def on_raw_bulk_message_delete(self, payload):
+		self.message_cache.invalidate(*payload.message_ids)
+
 		if payload.guild_id is None:
 			return
 
@@ -764,9 +1167,14 @@ class Starboard(AceMixin, commands.Cog):
 		if board is None or board.locked:
 			return
 
+		message_ids = self.starred_ids.filter(payload.guild_id, payload.message_ids)
+
+		if not message_ids:
+			return
+
 		sms = await self.db.fetch(
 			'SELECT * FROM star_msg WHERE message_id=ANY($1::bigint[]) OR star_message_id=ANY($1::bigint[])',
-			payload.message_ids
+			message_ids
 		)
 
 		if not sms:
@@ -778,6 +1186,9 @@ class Starboard(AceMixin, commands.Cog):
 		# delete from db
 		await self.db.execute('DELETE FROM star_msg WHERE id=ANY($1::bigint[])', ids)
 
+		for sm in sms:
+			self.starred_ids.remove(payload.guild_id, sm.get('message_id'), sm.get('star_message_id'))
+
 		guild = self.bot.get_guild(payload.guild_id)
 		if guild is None:
 			return
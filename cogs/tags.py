@@ -10,10 +10,18 @@ from cogs.mixins import AceMixin
 from utils.context import AceContext, can_prompt
 from utils.converters import LengthConverter, MaybeMemberConverter
 from utils.pager import Pager
+from utils.queries import register
 from utils.time import pretty_datetime
 
 log = logging.getLogger(__name__)
 
+TAG_EXISTS = register('tag.exists', 'SELECT id FROM tag WHERE guild_id=$1 AND (name=$2 OR alias=$2)')
+TAG_LOOKUP = register('tag.lookup', 'SELECT * FROM tag WHERE guild_id=$1 AND (name=$2 OR alias=$2)')
+TAG_SIMILAR = register(
+	'tag.similar', 'SELECT name, alias FROM tag WHERE guild_id=$1 AND (name % $2 OR alias % $2) LIMIT 5'
+)
+TAG_USED = register('tag.used', 'UPDATE tag SET uses=$2, viewed_at=$3 WHERE id=$1')
+
 
 def build_tag_name(record):
 	name = record.get('name')
@@ -52,10 +60,7 @@ class TagCreateConverter(LengthConverter):
 		if ctx.cog.tag_is_being_made(ctx, tag_name):
 			raise commands.BadArgument('Tag with that name is currently being made elsewhere.')
 
-		exist_id = await ctx.bot.db.fetchval(
-			'SELECT id FROM tag WHERE guild_id=$1 AND (name=$2 OR alias=$2)',
-			ctx.guild.id, tag_name
-		)
+		exist_id = await TAG_EXISTS.fetchval(ctx.bot.db, ctx.guild.id, tag_name)
 
 		if exist_id is not None:
 			raise commands.BadArgument('Tag name is already in use.')
@@ -75,10 +80,7 @@ class TagEditConverter(commands.Converter):
 	async def convert(self, ctx, tag_name):
 		tag_name = tag_name.lower()
 
-		rec = await ctx.bot.db.fetchrow(
-			'SELECT * FROM tag WHERE guild_id=$1 AND (name=$2 OR alias=$2)',
-			ctx.guild.id, tag_name
-		)
+		rec = await TAG_LOOKUP.fetchrow(ctx.bot.db, ctx.guild.id, tag_name)
 
 		if rec is None:
 			raise ACCESS_ERROR
@@ -100,20 +102,14 @@ class TagViewConverter(commands.Converter):
 	async def convert(self, ctx, tag_name):
 		tag_name = tag_name.lower()
 
-		rec = await ctx.bot.db.fetchrow(
-			'SELECT * FROM tag WHERE guild_id=$1 AND (name=$2 OR alias=$2)',
-			ctx.guild.id, tag_name
-		)
+		rec = await TAG_LOOKUP.fetchrow(ctx.bot.db, ctx.guild.id, tag_name)
 
 		if rec is not None:
 			return tag_name, rec
 
 		# otherwise, find a list of potential matches
 
-		similars = await ctx.bot.db.fetch(
-			'SELECT name, alias FROM tag WHERE guild_id=$1 AND (name % $2 OR alias % $2) LIMIT 5',
-			ctx.guild.id, tag_name
-		)
+		similars = await TAG_SIMILAR.fetch(ctx.bot.db, ctx.guild.id, tag_name)
 
 		if similars:
 			tag_list = '\n'.join(build_tag_name(record) for record in similars)
@@ -223,10 +219,7 @@ class Tags(AceMixin, commands.Cog):
 		tag_name, record = tag_name
 		await ctx.send(record.get('content'), allowed_mentions=discord.AllowedMentions.none())
 
-		await self.db.execute(
-			'UPDATE tag SET uses=$2, viewed_at=$3 WHERE id=$1',
-			record.get('id'), record.get('uses') + 1, datetime.utcnow()
-		)
+		await TAG_USED.execute(self.db, record.get('id'), record.get('uses') + 1, datetime.utcnow())
 
 	@tag.command(aliases=['add', 'new'])
 	async def create(self, ctx, tag_name: tag_create_converter, *, content: str = None):
@@ -1,4 +1,9 @@
 import asyncio
+import json
+import os
+import re
+import sys
+from datetime import datetime
 
 import asyncpg
 
@@ -6,11 +11,179 @@ from config import DB_BIND
 
 QUERIES = open('migrate.sql', 'r').read()
 
+MIGRATIONS_PATH = 'migrations'
+MIGRATION_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# migrations starting with this line are run one statement at a time outside of a transaction,
+# which CREATE INDEX CONCURRENTLY requires
+NO_TRANSACTION = '-- no transaction'
+
+# hot queries and the index each of them should use, checked with `python migrate.py --check`
+HOT_QUERIES = (
+	(
+		'log_guild_user_timestamp_idx',
+		'SELECT COUNT(id), command FROM log WHERE guild_id=$1 AND user_id=$2 AND timestamp > $3 GROUP BY command',
+		(0, 0, datetime(2000, 1, 1))
+	),
+	(
+		'log_guild_timestamp_idx',
+		'SELECT COUNT(id), user_id FROM log WHERE guild_id=$1 AND timestamp > $2 GROUP BY user_id',
+		(0, datetime(2000, 1, 1))
+	),
+	(
+		'star_msg_star_message_id_idx',
+		'SELECT * FROM star_msg WHERE guild_id=$1 AND (message_id=$2 OR star_message_id=$2)',
+		(0, 0)
+	),
+	(
+		'highlight_msg_message_user_idx',
+		'DELETE FROM highlight_msg WHERE user_id=$1 AND message_id=$2',
+		(0, 0)
+	),
+	(
+		'tag_guild_name_idx',
+		'SELECT * FROM tag WHERE guild_id=$1 AND (name=$2 OR alias=$2)',
+		(0, 'tag')
+	),
+	(
+		'tag_name_trgm_idx',
+		'SELECT name, alias FROM tag WHERE guild_id=$1 AND (name % $2 OR alias % $2) LIMIT 5',
+		(0, 'tag')
+	),
+	(
+		'remind_remind_on_idx',
+		'SELECT * FROM remind WHERE remind_on < $1 AND remind_on IS NOT NULL',
+		(datetime(2000, 1, 1),)
+	),
+	(
+		'remind_user_guild_idx',
+		'SELECT * FROM remind WHERE guild_id=$1 AND user_id=$2 ORDER BY id DESC',
+		(0, 0)
+	),
+	(
+		'mod_timer_ends_at_idx',
+		'SELECT * FROM mod_timer WHERE duration IS NOT NULL AND created_at + duration < $1',
+		(datetime(2000, 1, 1),)
+	),
+)
+
 
 def log(connection, message):
 	print(message)
 
 
+def get_migrations():
+	migrations = list()
+
+	for file_name in os.listdir(MIGRATIONS_PATH):
+		match = MIGRATION_RE.match(file_name)
+		if match is None:
+			continue
+
+		with open(os.path.join(MIGRATIONS_PATH, file_name), 'r') as f:
+			migrations.append((int(match.group(1)), match.group(2), f.read()))
+
+	return sorted(migrations)
+
+
+def split_statements(sql):
+	for statement in sql.split(';\n'):
+		lines = [line for line in statement.strip().split('\n') if not line.lstrip().startswith('--')]
+
+		if any(line.strip() for line in lines):
+			yield statement.strip().rstrip(';')
+
+
+async def run_migrations(db):
+	applied = set(record.get('version') for record in await db.fetch('SELECT version FROM schema_migration'))
+
+	for version, name, sql in get_migrations():
+		if version in applied:
+			continue
+
+		print('Applying migration {0} {1}'.format(version, name))
+
+		if sql.startswith(NO_TRANSACTION):
+			for statement in split_statements(sql):
+				await db.execute(statement)
+
+			# a failed concurrent build leaves an invalid index behind that IF NOT EXISTS would skip
+			invalid = await db.fetch(
+				'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid'
+			)
+
+			if invalid:
+				names = ', '.join(record.get('relname') for record in invalid)
+				raise RuntimeError('Invalid indexes left behind, drop them and run again: {0}'.format(names))
+
+			await db.execute(
+				'INSERT INTO schema_migration (version, name, applied_at) VALUES ($1, $2, $3)',
+				version, name, datetime.utcnow()
+			)
+		else:
+			async with db.transaction():
+				await db.execute(sql)
+				await db.execute(
+					'INSERT INTO schema_migration (version, name, applied_at) VALUES ($1, $2, $3)',
+					version, name, datetime.utcnow()
+				)
+
+
+def plan_indexes(plan):
+	if 'Index Name' in plan:
+		yield plan['Index Name']
+
+	for child in plan.get('Plans', ()):
+		yield from plan_indexes(child)
+
+
+async def check_indexes(db):
+	'''EXPLAIN every hot query and make sure it can use its index. Returns False if any can't.
+
+	On a near empty table the planner is free to pick any index that covers a query, so each
+	query is planned with the other hot query indexes on its table dropped, in a transaction
+	that is rolled back afterwards.
+	'''
+
+	ok = True
+
+	tables = dict(
+		(record.get('indexname'), record.get('tablename')) for record in await db.fetch(
+			'SELECT indexname, tablename FROM pg_indexes WHERE indexname = ANY($1::text[])',
+			[index for index, _, _ in HOT_QUERIES]
+		)
+	)
+
+	for index, query, args in HOT_QUERIES:
+		tr = db.transaction()
+		await tr.start()
+
+		try:
+			# dropping takes an exclusive lock on the table, don't queue up behind the bot for long
+			await db.execute('SET LOCAL lock_timeout = \'5s\'')
+
+			for other, table in tables.items():
+				if other != index and table == tables.get(index, None):
+					await db.execute('DROP INDEX {0}'.format(other))
+
+			# small tables are cheaper to scan, but the question is whether the index *can* be used
+			await db.execute('SET LOCAL enable_seqscan = off')
+			plan = json.loads(await db.fetchval('EXPLAIN (FORMAT JSON) ' + query, *args))
+		finally:
+			await tr.rollback()
+
+		used = set(plan_indexes(plan[0]['Plan']))
+
+		if index in used:
+			print('OK      {0}'.format(index))
+		else:
+			ok = False
+			print('MISSING {0}, plan uses: {1}'.format(index, ', '.join(used) or 'no indexes'))
+			print('        {0}'.format(query))
+
+	return ok
+
+
 async def main():
 	db = await asyncpg.connect(DB_BIND)
 	db.add_log_listener(log)
@@ -23,6 +196,11 @@ async def main():
 			for fact in facts.split('\n'):
 				await db.execute('INSERT INTO facts (content) VALUES ($1)', fact)
 
+	await run_migrations(db)
+
+	if '--check' in sys.argv and not await check_indexes(db):
+		sys.exit(1)
+
 
 facts = """
 If you somehow found a way to extract all of the gold from the bubbling core of our lovely little planet, you would be able to cover all of the land in a layer of gold up to your knees.
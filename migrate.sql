@@ -9,6 +9,13 @@ BEGIN
     END IF;
 END$$;
 
+-- applied versioned migrations from the migrations folder
+CREATE TABLE IF NOT EXISTS schema_migration (
+	version		INT PRIMARY KEY,
+	name		TEXT NOT NULL,
+	applied_at	TIMESTAMP NOT NULL
+);
+
 -- guild config
 CREATE TABLE IF NOT EXISTS config (
 	id 					SERIAL UNIQUE,
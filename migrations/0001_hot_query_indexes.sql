@@ -0,0 +1,47 @@
+-- no transaction
+-- indexes for the queries run on every command, reaction and message delete.
+-- built concurrently so they can be applied to a running instance.
+
+-- command stats in meta, per member and per guild. INCLUDE lets the counts run as index-only scans
+CREATE INDEX CONCURRENTLY IF NOT EXISTS log_guild_user_timestamp_idx
+	ON log (guild_id, user_id, timestamp) INCLUDE (command, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS log_guild_timestamp_idx
+	ON log (guild_id, timestamp) INCLUDE (command, user_id, id);
+
+-- star lookups by starboard message, message_id is already covered by its UNIQUE constraint
+CREATE INDEX CONCURRENTLY IF NOT EXISTS star_msg_star_message_id_idx
+	ON star_msg (star_message_id) WHERE star_message_id IS NOT NULL;
+
+-- star cooldown, latest star by a starrer in a guild
+CREATE INDEX CONCURRENTLY IF NOT EXISTS star_msg_guild_starrer_idx
+	ON star_msg (guild_id, starrer_id, id DESC) INCLUDE (starred_at);
+
+-- highlight delete reaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS highlight_msg_message_user_idx
+	ON highlight_msg (message_id, user_id);
+
+-- tag lookup by name or alias
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tag_guild_name_idx
+	ON tag (guild_id, name);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tag_guild_alias_idx
+	ON tag (guild_id, alias) WHERE alias IS NOT NULL;
+
+-- similar tag suggestions, uses the pg_trgm % operator
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tag_name_trgm_idx
+	ON tag USING gin (name gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tag_alias_trgm_idx
+	ON tag USING gin (alias gin_trgm_ops);
+
+-- reminder timer window and claims, and reminder listing/counting
+CREATE INDEX CONCURRENTLY IF NOT EXISTS remind_remind_on_idx
+	ON remind (remind_on);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS remind_user_guild_idx
+	ON remind (user_id, guild_id);
+
+-- mod timer window and claims, on the same expression EventTimer filters on
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mod_timer_ends_at_idx
+	ON mod_timer ((created_at + duration)) WHERE duration IS NOT NULL;
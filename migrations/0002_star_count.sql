@@ -0,0 +1,7 @@
+-- total stars of a starred message, the original starrer plus everyone in starrers.
+-- kept up to date by the statements that add and remove starrers
+ALTER TABLE star_msg ADD COLUMN IF NOT EXISTS star_count INT NOT NULL DEFAULT 1;
+
+UPDATE star_msg SET star_count = 1 + counts.starrers
+FROM (SELECT star_id, COUNT(*) AS starrers FROM starrers GROUP BY star_id) AS counts
+WHERE star_msg.id = counts.star_id;
@@ -0,0 +1,3 @@
+-- how many mentions a role mention and an @everyone/@here mention count as in the mention spam check
+ALTER TABLE mod_config ADD COLUMN IF NOT EXISTS mention_role_weight SMALLINT NOT NULL DEFAULT 2;
+ALTER TABLE mod_config ADD COLUMN IF NOT EXISTS mention_everyone_weight SMALLINT NOT NULL DEFAULT 4;
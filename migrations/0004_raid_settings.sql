@@ -0,0 +1,5 @@
+-- raid mode starts when raid_count suspicious members join within raid_per seconds,
+-- and raid_action is taken against every suspicious member joining until it ends
+ALTER TABLE mod_config ADD COLUMN IF NOT EXISTS raid_action security_action NOT NULL DEFAULT 'KICK';
+ALTER TABLE mod_config ADD COLUMN IF NOT EXISTS raid_count SMALLINT NOT NULL DEFAULT 10;
+ALTER TABLE mod_config ADD COLUMN IF NOT EXISTS raid_per SMALLINT NOT NULL DEFAULT 10;
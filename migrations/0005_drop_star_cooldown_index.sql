@@ -0,0 +1,4 @@
+-- no transaction
+-- star cooldowns are kept in memory, nothing queries star_msg by starrer anymore.
+-- 0001 created this index for them
+DROP INDEX CONCURRENTLY IF EXISTS star_msg_guild_starrer_idx;
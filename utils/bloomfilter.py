@@ -0,0 +1,44 @@
+import math
+
+MASK = 0xFFFFFFFFFFFFFFFF
+
+
+class BloomFilter:
+	'''Fixed size Bloom filter of integers, like Discord IDs.
+
+	Never gives false negatives, and false positives at roughly `error_rate` as long as no more than
+	`capacity` values are added. Values can't be removed.
+	'''
+
+	def __init__(self, capacity, error_rate=0.01):
+		capacity = max(1, capacity)
+
+		self.capacity = capacity
+		self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+		self.hashes = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def _positions(self, value):
+		# double hashing with two 64 bit mixes of the value
+		h1 = (value * 0x9E3779B97F4A7C15) & MASK
+		h2 = (((value ^ (value >> 31)) * 0xBF58476D1CE4E5B9) & MASK) | 1
+
+		for idx in range(self.hashes):
+			yield (h1 + idx * h2) % self.size
+
+	def add(self, value):
+		for pos in self._positions(value):
+			self.bits[pos >> 3] |= 1 << (pos & 7)
+
+		self.count += 1
+
+	def __contains__(self, value):
+		for pos in self._positions(value):
+			if not self.bits[pos >> 3] & (1 << (pos & 7)):
+				return False
+
+		return True
+
+	def __len__(self):
+		return self.count
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from time import perf_counter
+
+from aiohttp import web
+
+from utils.metrics import MetricsRegistry
+
+
+log = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = 1.0
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class BotMetrics:
+	'''Every metric the bot exposes, served in the Prometheus text format on a local port.'''
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.registry = registry = MetricsRegistry()
+
+		# gateway
+		self.gateway_events = registry.counter('gateway_events_total', 'Gateway events received.', ('event',))
+		registry.gauge('gateway_latency_seconds', 'Heartbeat latency.', callback=self._gateway_latency)
+		registry.gauge('guilds', 'Guilds this process is in.', callback=lambda: {(): len(bot.guilds)})
+
+		# commands
+		self.commands = registry.histogram(
+			'command_duration_seconds', 'Time spent running commands.', ('command', 'status')
+		)
+
+		# database
+		registry.gauge('db_pool_connections', 'Pool connections by state.', ('state',), callback=self._pool_usage)
+		registry.histogram('db_pool_wait_seconds', 'Time spent acquiring a pool connection.', callback=self._pool_wait)
+		registry.counter('db_queries_total', 'Queries run, by outcome.', ('outcome',), callback=self._queries)
+		registry.counter('db_slow_queries_total', 'Queries over the slow query threshold.', callback=self._slow_queries)
+		registry.gauge(
+			'command_log_queued', 'Command log rows waiting to be written.',
+			callback=lambda: {(): len(bot.command_log.queue)}
+		)
+		registry.counter(
+			'command_log_dropped_total', 'Command log rows dropped because the buffer was full.',
+			callback=lambda: {(): bot.command_log.dropped}
+		)
+
+		# outbound http
+		self.http = registry.histogram(
+			'http_request_duration_seconds', 'Outbound HTTP request latency.', ('host', 'status')
+		)
+
+		# event loop
+		self.loop_lag = registry.histogram(
+			'loop_lag_seconds', 'How late the event loop wakes up a sleeping task.', buckets=LOOP_LAG_BUCKETS
+		)
+
+		# caches
+		registry.gauge('cache_entries', 'Cached ConfigTable entries.', ('table', 'kind'), callback=self._cache_sizes)
+		registry.counter('cache_lookups_total', 'ConfigTable lookups.', ('table', 'result'), callback=self._cache_lookups)
+		registry.counter('cache_evictions_total', 'ConfigTable evictions.', ('table',), callback=self._cache_evictions)
+		registry.gauge('message_cache_size', 'Messages in the discord.py message cache.', callback=self._message_cache)
+
+		self._runner = None
+		self._lag_task = None
+
+	def _gateway_latency(self):
+		latency = self.bot.latency
+		return {} if latency != latency else {(): latency}  # NaN before the first heartbeat
+
+	def _pool_usage(self):
+		pool = self.bot.db
+
+		if hasattr(pool, 'get_size'):
+			size, idle = pool.get_size(), pool.get_idle_size()
+		else:
+			holders = [holder for holder in pool._holders if holder._con is not None]
+			size = len(holders)
+			idle = sum(1 for holder in holders if holder._in_use is None)
+
+		return {('idle',): idle, ('in_use',): size - idle}
+
+	def _pool_wait(self):
+		query_stats = self.bot.query_stats
+		return {} if query_stats is None else {(): query_stats.pool_wait}
+
+	def _queries(self):
+		query_stats = self.bot.query_stats
+		if query_stats is None:
+			return {}
+
+		calls = sum(stats.calls for stats in query_stats.templates.values())
+		errors = sum(stats.errors for stats in query_stats.templates.values())
+
+		return {('ok',): calls - errors, ('error',): errors}
+
+	def _slow_queries(self):
+		query_stats = self.bot.query_stats
+		return {} if query_stats is None else {(): query_stats.slow_queries}
+
+	def _cache_sizes(self):
+		data = dict()
+
+		for table in self.bot.config_tables:
+			stats = table.stats
+			data[(table.table, 'entry')] = stats['entries']
+			data[(table.table, 'non_existent')] = stats['non_existent']
+
+		return data
+
+	def _cache_lookups(self):
+		data = dict()
+
+		for table in self.bot.config_tables:
+			stats = table.stats
+			data[(table.table, 'hit')] = stats['hits']
+			data[(table.table, 'miss')] = stats['misses']
+
+		return data
+
+	def _cache_evictions(self):
+		return {(table.table,): table.stats['evictions'] for table in self.bot.config_tables}
+
+	def _message_cache(self):
+		messages = self.bot.cached_messages
+		return {(): len(messages)}
+
+	def observe_command(self, ctx, status):
+		started_at = getattr(ctx, 'started_at', None)
+
+		if started_at is not None and ctx.command is not None:
+			self.commands.labels(ctx.command.qualified_name, status).observe(perf_counter() - started_at)
+
+	async def measure_loop_lag(self):
+		while True:
+			start = perf_counter()
+			await asyncio.sleep(LOOP_LAG_INTERVAL)
+			self.loop_lag.observe(max(0.0, perf_counter() - start - LOOP_LAG_INTERVAL))
+
+	async def handle_metrics(self, request):
+		return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+	async def start(self, host, port):
+		app = web.Application()
+		app.router.add_get('/metrics', self.handle_metrics)
+
+		self._runner = web.AppRunner(app, access_log=None)
+		await self._runner.setup()
+
+		site = web.TCPSite(self._runner, host, port)
+		await site.start()
+
+		self._lag_task = self.bot.loop.create_task(self.measure_loop_lag())
+
+		log.info('Serving metrics on http://%s:%s/metrics', host, port)
+
+	async def close(self):
+		if self._lag_task is not None:
+			self._lag_task.cancel()
+
+		if self._runner is not None:
+			await self._runner.cleanup()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from collections import deque
+from time import perf_counter
+
+import asyncpg
+
+
+log = logging.getLogger(__name__)
+
+
+class CommandLog:
+	'''Write-behind buffer for the command log table.
+
+	Rows are kept in a bounded in-memory queue and written with COPY once `flush_rows` rows
+	have queued up or `flush_interval` seconds have passed, whichever comes first.
+	'''
+
+	COLUMNS = ('guild_id', 'channel_id', 'user_id', 'timestamp', 'command')
+
+	def __init__(self, bot, table='log', max_size=10000, flush_rows=200, flush_interval=2.0):
+		self.bot = bot
+		self.table = table
+		self.max_size = max_size
+		self.flush_rows = flush_rows
+		self.flush_interval = flush_interval
+
+		self.queue = deque()
+
+		# counters
+		self.written = 0
+		self.dropped = 0
+		self.flushes = 0
+		self.flush_time = 0.0
+		self.last_flush_time = None
+		self.max_flush_time = 0.0
+
+		self._closing = False
+		self._wakeup = asyncio.Event()
+		self.task = self.start_task()
+
+	def start_task(self):
+		return self.bot.loop.create_task(self.flusher())
+
+	def append(self, guild_id, channel_id, user_id, timestamp, command):
+		'''Queue a row. Returns False if the queue is full and the row was dropped.'''
+
+		if len(self.queue) >= self.max_size:
+			self.dropped += 1
+			return False
+
+		self.queue.append((guild_id, channel_id, user_id, timestamp, command))
+
+		if len(self.queue) >= self.flush_rows:
+			self._wakeup.set()
+
+		return True
+
+	async def flusher(self):
+		while not self._closing:
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+			except asyncio.TimeoutError:
+				pass
+
+			self._wakeup.clear()
+
+			await self._safe_flush()
+
+		# final drain after close() was called
+		await self._safe_flush()
+
+	async def _safe_flush(self):
+		# the flusher must outlive anything flush raises, or rows pile up until the queue is full
+		try:
+			await self.flush()
+		except asyncio.CancelledError:
+			raise
+		except Exception:
+			log.exception('Unexpected error flushing to %s', self.table)
+
+	async def flush(self):
+		'''Write all queued rows. Returns the amount of rows written.'''
+
+		if not self.queue:
+			return 0
+
+		rows = list(self.queue)
+		self.queue.clear()
+
+		start = perf_counter()
+
+		try:
+			async with self.bot.db.acquire() as con:
+				await con.copy_records_to_table(self.table, records=rows, columns=self.COLUMNS)
+		except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+			# put the rows back in front of anything queued since, dropping what doesn't fit
+			room = max(0, self.max_size - len(self.queue))
+			self.dropped += max(0, len(rows) - room)
+			self.queue.extendleft(reversed(rows[:room]))
+
+			log.warning('Failed flushing %s rows to %s: %s', len(rows), self.table, str(exc))
+			return 0
+		except asyncio.CancelledError:
+			raise
+		except Exception:
+			# most likely something in the rows themselves, retrying them would fail the same way
+			self.dropped += len(rows)
+			raise
+
+		elapsed = perf_counter() - start
+
+		self.written += len(rows)
+		self.flushes += 1
+		self.flush_time += elapsed
+		self.last_flush_time = elapsed
+		self.max_flush_time = max(self.max_flush_time, elapsed)
+
+		log.debug('Flushed %s rows to %s in %.2fms', len(rows), self.table, elapsed * 1000)
+
+		return len(rows)
+
+	async def close(self):
+		'''Stop the flusher and drain whatever is left in the queue.'''
+
+		self._closing = True
+		self._wakeup.set()
+
+		await self.task
+
+		if self.queue:
+			log.warning('Discarding %s unwritten rows for %s', len(self.queue), self.table)
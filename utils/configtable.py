@@ -1,9 +1,22 @@
 import asyncio
+import json
 import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from time import monotonic, perf_counter
+from uuid import uuid4
+
+import asyncpg
 
 
 log = logging.getLogger(__name__)
 
+# ConfigTable writes are announced on this channel so other processes can drop their cached copy
+NOTIFY_CHANNEL = 'configtable'
+
+# identifies notifications sent by this process, so we don't evict our own fresh entries
+ORIGIN = uuid4().hex
+
 
 class ConfigTableRecord(object):
 	_data = dict()
@@ -13,6 +26,9 @@ class ConfigTableRecord(object):
 		self._data = dict()
 		self._dirty = set()
 
+		self._batching = 0
+		self._write_lock = asyncio.Lock()
+
 		for key, value in record.items():
 			self._data[key] = value
 
@@ -26,9 +42,6 @@ class ConfigTableRecord(object):
 		else:
 			self.__dict__[key] = value
 
-	def _build_dirty(self, start_at=1):
-		return ', '.join('{} = ${}'.format(key, idx + start_at) for idx, key in enumerate(self._dirty))
-
 	def _set_dirty(self, key):
 		if key not in self._data:
 			raise AttributeError('Attempted to set key {} to dirty, but it does not exist'.format(key))
@@ -37,6 +50,10 @@ class ConfigTableRecord(object):
 	def _clear_dirty(self):
 		self._dirty.clear()
 
+	@property
+	def is_dirty(self):
+		return bool(self._dirty)
+
 	def get(self, key):
 		if key in self._data:
 			return self._data[key]
@@ -57,22 +74,50 @@ class ConfigTableRecord(object):
 		if not self._dirty:
 			raise ValueError('No values dirty for table {}'.format(self._config.table))
 
-		query = 'UPDATE {} SET {} WHERE {}'.format(
-			self._config.table,
-			self._build_dirty(len(self._config.primary) + 1),
-			self._config.build_predicate()
-		)
+		# inside a batch() block the write happens once the block exits
+		if self._batching:
+			return
+
+		await self._write()
+
+	@asynccontextmanager
+	async def batch(self):
+		'''Coalesce every update() inside the block into a single write.'''
+
+		self._batching += 1
+
+		try:
+			yield self
+		finally:
+			self._batching -= 1
+
+		if not self._batching and self._dirty:
+			await self._write()
+
+	async def _write(self):
+		# concurrent writers queue up here. whoever gets the lock first writes everything
+		# that's dirty at that point, so the ones after it usually have nothing left to do
+		async with self._write_lock:
+			if not self._dirty:
+				return
 
-		keys = tuple(self._data[primary] for primary in self._config.primary)
-		values = tuple(self._data[key] for key in self._dirty)
+			columns = tuple(sorted(self._dirty))
+			self._clear_dirty()
 
-		await self._config.bot.db.execute(query, *keys, *values)
+			keys = tuple(self._data[primary] for primary in self._config.primary)
+			values = tuple(self._data[key] for key in columns)
 
-		self._clear_dirty()
+			try:
+				await self._config.bot.db.execute(self._config.get_update_query(columns), *keys, *values)
+			except BaseException:
+				self._dirty.update(columns)
+				raise
+
+		await self._config.publish(keys)
 
 
 class ConfigTable:
-	def __init__(self, bot, table, primary, record_class=None):
+	def __init__(self, bot, table, primary, record_class=None, max_entries=None, ttl=None):
 		record_class = record_class or ConfigTableRecord
 
 		if record_class is not ConfigTableRecord and not issubclass(record_class, ConfigTableRecord):
@@ -86,11 +131,29 @@ class ConfigTable:
 		self.bot = bot
 		self.table = table
 		self.primary = primary
-		self.entries = dict()
+
+		# both of these are kept in least to most recently used order
+		self.entries = OrderedDict()
+		self._non_existent = OrderedDict()
+
+		# eviction policy. max_entries bounds entries and _non_existent separately,
+		# ttl is in seconds since the entry was loaded
+		self.max_entries = max_entries
+		self.ttl = ttl
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
 
 		self._record_class = record_class
-		self._lock = asyncio.Lock()
-		self._non_existent = set()
+		self._loaded_at = dict()
+
+		# in-flight loads, so concurrent misses for the same keys share one query
+		self._pending = dict()
+
+		# UPDATE statements keyed by the (sorted) columns they set. keeping the query text stable
+		# for a set of columns lets asyncpg reuse its prepared statement for it
+		self._update_queries = dict()
 
 		log.debug('Constructed ConfigTable for table %s with keys %s', table, primary)
 
@@ -101,23 +164,94 @@ class ConfigTable:
 		return tuple(record.get(primary) for primary in self.primary)
 
 	@property
-	def _insert_query(self):
-		return 'INSERT INTO {} ({}) VALUES ({})'.format(
+	def _get_query(self):
+		return 'SELECT * FROM {} WHERE '.format(self.table) + self.build_predicate()
+
+	@property
+	def _upsert_query(self):
+		# DO NOTHING leaves existing rows alone, so those come from the SELECT instead. it runs on
+		# the snapshot from before the insert, so exactly one of the two yields a row, unless
+		# another transaction inserted it since, in which case neither does
+		return (
+			'WITH inserted AS (INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT DO NOTHING RETURNING *) '
+			'SELECT *, TRUE AS _inserted FROM inserted UNION ALL SELECT *, FALSE FROM {0} WHERE {3}'
+		).format(
 			self.table,
 			', '.join(self.primary),
-			', '.join('${}'.format(idx + 1) for idx, _ in enumerate(self.primary))
+			', '.join('${}'.format(idx + 1) for idx, _ in enumerate(self.primary)),
+			self.build_predicate()
 		)
 
+	def get_update_query(self, columns):
+		query = self._update_queries.get(columns, None)
+
+		if query is None:
+			query = 'UPDATE {} SET {} WHERE {}'.format(
+				self.table,
+				', '.join('{} = ${}'.format(key, idx + len(self.primary) + 1) for idx, key in enumerate(columns)),
+				self.build_predicate()
+			)
+
+			self._update_queries[columns] = query
+
+		return query
+
+	def _expired(self, keys):
+		return self.ttl is not None and monotonic() - self._loaded_at.get(keys, 0.0) > self.ttl
+
+	def _cache_entry(self, keys, entry):
+		self._non_existent.pop(keys, None)
+		self.entries[keys] = entry
+		self.entries.move_to_end(keys)
+		self._loaded_at[keys] = monotonic()
+		self._evict()
+
+	def _cache_non_existent(self, keys):
+		self._non_existent[keys] = None
+		self._non_existent.move_to_end(keys)
+		self._loaded_at[keys] = monotonic()
+		self._evict()
+
+	def _evict(self):
+		if self.max_entries is None:
+			return
+
+		overflow = len(self.entries) - self.max_entries
+
+		if overflow > 0:
+			victims = list()
+
+			# oldest first, and usually only one is needed, so stop as soon as there are enough.
+			# dirty records have changes not yet written, those stay until they're clean
+			for keys, entry in self.entries.items():
+				if not entry.is_dirty:
+					victims.append(keys)
+
+					if len(victims) == overflow:
+						break
+
+			for keys in victims:
+				self._drop(keys)
+
+			self.evictions += len(victims)
+
+		while len(self._non_existent) > self.max_entries:
+			keys, _ = self._non_existent.popitem(last=False)
+			self._loaded_at.pop(keys, None)
+			self.evictions += 1
+
+	def _drop(self, keys):
+		self._loaded_at.pop(keys, None)
+		self._non_existent.pop(keys, None)
+		return self.entries.pop(keys, None)
+
 	async def insert_record(self, record, keys=None):
 		keys = keys or self.get_keys_from_record(record)
 
-		if keys in self._non_existent:
-			self._non_existent.remove(keys)
-
 		log.debug('Inserting record with keys %s for table %s', keys, self.table)
 
 		entry = self._record_class(self, record)
-		self.entries[keys] = entry
+		self._cache_entry(keys, entry)
 
 		return entry
 
@@ -128,47 +262,275 @@ class ConfigTable:
 			if not isinstance(key, int):
 				raise TypeError('Primary key must be int.')
 
-		if not construct and keys in self._non_existent:
-			return None
+		# fast path, no locking needed when the entry is cached
+		entry = self.entries.get(keys, None)
+		if entry is not None:
+			if not self._expired(keys) or entry.is_dirty:
+				self.hits += 1
+				self.entries.move_to_end(keys)
+				return entry
+
+			self._drop(keys)
+			self.evictions += 1
+
+		elif keys in self._non_existent:
+			if self._expired(keys):
+				self._drop(keys)
+				self.evictions += 1
+			elif not construct:
+				self.hits += 1
+				self._non_existent.move_to_end(keys)
+				return None
+
+		self.misses += 1
+
+		while True:
+			task = self._pending.get(keys, None)
+
+			if task is None:
+				task = self.bot.loop.create_task(self._load_entry(keys, construct))
+				task.add_done_callback(lambda t: self._pop_pending(keys, t))
+				self._pending[keys] = task
+
+			entry = await asyncio.shield(task)
 
-		async with self._lock:
-			if keys in self.entries:
-				return self.entries[keys]
+			# if we joined a load that wasn't allowed to construct, start one that is
+			if entry is not None or not construct:
+				return entry
 
-			get_query = 'SELECT * FROM {} WHERE '.format(self.table) + self.build_predicate()
+	def _pop_pending(self, keys, task):
+		if self._pending.get(keys, None) is task:
+			self._pending.pop(keys)
 
-			record = await self.bot.db.fetchrow(get_query, *keys)
+	async def _load_entry(self, keys, construct):
+		if keys in self.entries:
+			return self.entries[keys]
+
+		if construct:
+			# fetch or create the row in one round trip
+			record = await self.bot.db.fetchrow(self._upsert_query, *keys)
+
+			if record is None:
+				# lost a race with another insert of the same row, which is there to read now
+				record = await self.bot.db.fetchrow(self._get_query, *keys)
+			else:
+				record = dict(record)
+
+				# other processes might have a new row cached as non-existent
+				if record.pop('_inserted'):
+					await self.publish(keys)
+		else:
+			record = await self.bot.db.fetchrow(self._get_query, *keys)
 
 			if record is None:
-				if not construct:
-					self._non_existent.add(keys)
-					return None
-				elif keys in self._non_existent:
-					self._non_existent.remove(keys)
+				self._cache_non_existent(keys)
+				return None
+
+		return await self.insert_record(record, keys=keys)
+
+	async def preload(self, known_keys=None):
+		'''Stream the whole table into the cache using a single cursor.
 
-				await self.bot.db.execute(self._insert_query, *keys)
-				record = await self.bot.db.fetchrow(get_query, *keys)
+		Keys in `known_keys` that turn out to have no row are marked as non-existent.
+		Returns the amount of records loaded and the time it took.'''
 
-			return await self.insert_record(record, keys=keys)
+		start = perf_counter()
+		found = set()
+
+		async with self.bot.db.acquire() as con:
+			async with con.transaction():
+				async for record in con.cursor('SELECT * FROM {}'.format(self.table)):
+					keys = self.get_keys_from_record(record)
+					found.add(keys)
+
+					# don't clobber entries that were loaded (and maybe modified) in the meantime
+					if keys not in self.entries:
+						self._cache_entry(keys, self._record_class(self, record))
+
+		if known_keys is not None:
+			for keys in known_keys:
+				keys = tuple(keys)
+				if keys not in found and keys not in self.entries:
+					self._cache_non_existent(keys)
+
+		elapsed = perf_counter() - start
+
+		log.info('Preloaded %s records for table %s in %.2fs', len(found), self.table, elapsed)
+
+		return len(found), elapsed
 
 	def has_entry(self, *keys):
 		return tuple(keys) in self.entries
 
+	@property
+	def stats(self):
+		'''Cache counters for this table.'''
+
+		return dict(
+			entries=len(self.entries),
+			non_existent=len(self._non_existent),
+			hits=self.hits,
+			misses=self.misses,
+			evictions=self.evictions,
+		)
+
 	async def clear_entry(self, *keys):
 		'''Returns True if key(s) found in entries dict.'''
 
+		return self.evict(*keys)
+
+	def evict(self, *keys):
+		'''Drop key(s) from the cache. Returns True if an entry was removed.'''
+
 		keys = tuple(keys)
 
-		async with self._lock:
-			if keys in self._non_existent:
-				log.info('Clearing non-existent entry %s for table %s', keys, self.table)
-				self._non_existent.remove(keys)
+		if keys in self._non_existent:
+			log.debug('Clearing non-existent entry %s for table %s', keys, self.table)
+
+		removed = self._drop(keys) is not None
+
+		if removed:
+			log.debug('Clearing entry %s for table %s', keys, self.table)
+
+		return removed
+
+	def invalidate(self, *keys):
+		'''Handle a change made to a row elsewhere. Returns True if a cached entry was affected.
+
+		Clean entries are dropped so they're loaded again. Entries with unwritten changes can't be,
+		those are read again in the background instead, keeping the changed values.'''
+
+		keys = tuple(keys)
+		entry = self.entries.get(keys, None)
+
+		if entry is None or not entry.is_dirty:
+			return self.evict(*keys)
+
+		self.bot.loop.create_task(self._refresh(keys, entry))
+		return True
+
+	async def _refresh(self, keys, entry):
+		# holding the lock keeps our own writes from landing between reading the row and applying it
+		async with entry._write_lock:
+			try:
+				record = await self.bot.db.fetchrow(self._get_query, *keys)
+			except (asyncpg.PostgresError, OSError) as exc:
+				log.warning('Failed refreshing %s in table %s: %s', keys, self.table, str(exc))
+				return
+
+			if record is None:
+				return
+
+			for key, value in record.items():
+				if key in entry._data and key not in entry._dirty:
+					entry._data[key] = value
+
+		log.debug('Refreshed dirty entry %s for table %s', keys, self.table)
+
+	def evict_all(self):
+		'''Drop everything cached, except records with unwritten changes.'''
+
+		for keys, entry in list(self.entries.items()):
+			if not entry.is_dirty:
+				self._drop(keys)
+
+		for keys in list(self._non_existent.keys()):
+			self._drop(keys)
+
+	async def publish(self, keys):
+		'''Tell other processes that the row with these keys changed.'''
+
+		payload = json.dumps(dict(origin=ORIGIN, table=self.table, keys=list(keys)))
+
+		try:
+			await self.bot.db.execute('SELECT pg_notify($1, $2)', NOTIFY_CHANNEL, payload)
+		except (asyncpg.PostgresError, OSError) as exc:
+			log.warning('Failed publishing change of %s in table %s: %s', keys, self.table, str(exc))
+
+
+class ConfigTableListener:
+	'''Keeps ConfigTable caches coherent across processes.
+
+	Listens for change notifications on a dedicated connection and invalidates the changed
+	entries, so the next get_entry reloads them. If the connection drops, notifications
+	might have been missed, so every cache is cleared after reconnecting.
+	'''
+
+	RETRY_DELAY = 15.0
+	CHECK_INTERVAL = 5.0
+
+	def __init__(self, bot, dsn):
+		self.bot = bot
+		self.dsn = dsn
+
+		self.received = 0
+		self.evicted = 0
+
+		self.task = self.start_task()
+
+	def start_task(self):
+		return self.bot.loop.create_task(self.listen())
+
+	async def listen(self):
+		connected_before = False
+
+		while True:
+			con = None
+
+			try:
+				con = await asyncpg.connect(self.dsn)
+				await con.add_listener(NOTIFY_CHANNEL, self.on_notification)
+
+				if connected_before:
+					log.info('Reconnected ConfigTable listener, clearing caches')
+					for table in self.bot.config_tables:
+						table.evict_all()
+
+				connected_before = True
+
+				while not con.is_closed():
+					await asyncio.sleep(self.CHECK_INTERVAL)
+
+			except asyncio.CancelledError:
+				raise
+
+			except (asyncpg.PostgresError, OSError) as exc:
+				log.warning('ConfigTable listener got exception %s: reconnecting in %s seconds', str(exc), self.RETRY_DELAY)
+
+			except Exception:
+				# anything else, like a connect timeout, mustn't end the task or caches go stale for good
+				log.exception('ConfigTable listener failed: reconnecting in %s seconds', self.RETRY_DELAY)
+
+			finally:
+				# nothing but LISTEN runs on this connection, so there's nothing to close gracefully
+				if con is not None and not con.is_closed():
+					con.terminate()
+
+			await asyncio.sleep(self.RETRY_DELAY)
+
+	async def close(self):
+		'''Stop listening and close the connection.'''
+
+		self.task.cancel()
 
-			removed = bool(self.entries.pop(keys, False))
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
 
-			if removed:
-				log.info('Clearing entry %s for table %s', keys, self.table)
+	def on_notification(self, con, pid, channel, payload):
+		try:
+			data = json.loads(payload)
+			origin, table_name, keys = data['origin'], data['table'], tuple(data['keys'])
+		except (ValueError, KeyError, TypeError):
+			log.warning('Malformed ConfigTable notification: %s', payload)
+			return
 
-			return removed
+		if origin == ORIGIN:
+			return
 
+		self.received += 1
 
+		for table in self.bot.config_tables:
+			if table.table == table_name and table.invalidate(*keys):
+				self.evicted += 1
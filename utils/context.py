@@ -37,6 +37,9 @@ class AceContext(commands.Context):
 	def __init__(self, **kwargs):
 		super().__init__(**kwargs)
 
+		# set right before the command is invoked, used for command timings
+		self.started_at = None
+
 	@property
 	def db(self):
 		return self.bot.db
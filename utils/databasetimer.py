@@ -1,9 +1,11 @@
 import asyncio
 import discord
 import asyncpg
+import heapq
 import logging
 
 from datetime import datetime, timedelta
+from itertools import count
 
 from utils.time import pretty_timedelta
 
@@ -12,81 +14,209 @@ log = logging.getLogger(__name__)
 
 
 class DatabaseTimer:
-	MAX_SLEEP = timedelta(days=40)
+	'''Dispatches an event for each record once its time has come.
+
+	Records due within `WINDOW` are loaded into a heap with one query. The heap decides when to
+	wake up, the database decides what fires: every due record is claimed with one
+	`DELETE ... RETURNING` and only the claimed records are dispatched, as bot events. Listeners
+	hold `limit` while they work, so no more than `CONCURRENCY` records are handled at a time
+	when a big batch comes due. Records created or removed while the bot runs are added to and
+	removed from the heap with `add` and `remove_if`, the window is only queried again once it
+	has passed, or when `reload` is called.
+	'''
+
+	WINDOW = timedelta(hours=1)
+	CONCURRENCY = 8
 
 	def __init__(self, bot, event_name):
 		self.bot = bot
 		self.event_name = event_name
 
-		self.record = None
+		self.heap = list()
+		self.ids = set()
+		self.window_end = None
+
+		self._counter = count()
+		self._wakeup = asyncio.Event()
+		self.limit = asyncio.Semaphore(self.CONCURRENCY)
+
+		# changes made while the window is being loaded, applied on top of the loaded records
+		self._loading = False
+		self._added = list()
+		self._removed = list()
+
 		self.task = self.start_task()
 
 	def start_task(self):
 		return self.bot.loop.create_task(self.dispatch())
 
-	def restart_task(self):
-		self.task.cancel()
-		self.task = self.start_task()
-
 	async def dispatch(self):
+		while True:
+			try:
+				await self._run()
+			except (discord.ConnectionClosed, asyncpg.PostgresConnectionError, OSError) as e:
+				# if anything happened, sleep for 15 seconds then load the window again
+				log.warning('DatabaseTimer got exception %s: attempting restart in 15 seconds', str(e))
+
+				self.window_end = None
+				await asyncio.sleep(15)
+
+	async def _run(self):
+		while True:
+			now = datetime.utcnow()
+
+			if self.window_end is None or now >= self.window_end:
+				await self.load_window(now)
+
+			# sleep until the next record is due, the window ends, or the heap changes
+			then = self.window_end if not self.heap else min(self.heap[0][0], self.window_end)
+
+			if now < then:
+				log.debug('%s waking up in %s', self.event_name, pretty_timedelta(then - now))
+
+				self._wakeup.clear()
+
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), timeout=(then - now).total_seconds())
+				except asyncio.TimeoutError:
+					pass
+
+			await self.fire_due()
+
+	async def load_window(self, now):
+		self._loading = True
+		self._added.clear()
+		self._removed.clear()
+
+		window_end = now + self.WINDOW
+
 		try:
-			while True:
-				# fetch next record
-				record = await self.get_record()
+			records = await self.get_records(window_end)
+		finally:
+			self._loading = False
+
+		self.heap = list()
+		self.ids = set()
+		self.window_end = window_end
+
+		for record in records:
+			self._push(record)
+
+		for record in self._added:
+			self._push(record)
+
+		for pred in self._removed:
+			self._remove(pred)
+
+		heapq.heapify(self.heap)
 
-				# if none was found, sleep for 40 days and check again
-				if record is None:
-					log.debug('No record found for %s, sleeping', self.event_name)
-					await asyncio.sleep(self.MAX_SLEEP.total_seconds())
-					continue
+		log.debug('%s loaded %s records due before %s', self.event_name, len(self.heap), window_end)
 
-				# we are now with this record
-				self.record = record
+	async def fire_due(self):
+		now = datetime.utcnow()
 
-				# get datetime again in case query took a lot of time
-				now = datetime.utcnow()
-				then = self.when(record)
-				dt = then - now
+		if not self.heap or self.heap[0][0] > now:
+			return
 
-				# if the next record is in the future, sleep until it should be invoked
-				if now < then:
-					log.debug('%s dispatching in %s', self.event_name, pretty_timedelta(then - now))
-					await asyncio.sleep(dt.total_seconds())
+		# deleting the rows is what claims them. if another process claims at the same time it
+		# blocks on the row locks and skips the rows deleted here, so each record fires once
+		records = await self.claim_records(now)
+		claimed = set(record.get('id') for record in records)
 
-				await self.cleanup_record(record)
-				self.record = None
+		# due records that weren't claimed were deleted or claimed elsewhere in the meantime
+		while self.heap and self.heap[0][0] <= now:
+			self.ids.discard(heapq.heappop(self.heap)[2].get('id'))
 
-				log.debug('Dispatching event %s', self.event_name)
+		# claimed records the heap had down for later, only when they were changed behind its back
+		if not claimed.isdisjoint(self.ids):
+			self._remove(lambda record: record.get('id') in claimed)
+			heapq.heapify(self.heap)
 
-				# run it
-				self.bot.dispatch(self.event_name, record)
+		if not records:
+			return
 
-		except (discord.ConnectionClosed, asyncpg.PostgresConnectionError) as e:
-			# if anything happened, sleep for 15 seconds then attempt a restart
-			log.warning('DatabaseTimer got exception %s: attempting restart in 15 seconds', str(e))
+		log.debug('Dispatching %s %s events', len(records), self.event_name)
 
-			await asyncio.sleep(15)
-			self.restart_task()
+		for record in records:
+			self.bot.dispatch(self.event_name, record)
 
-	async def get_record(self):
+	def _push(self, record):
+		if record.get('id') in self.ids:
+			return
+
+		self.ids.add(record.get('id'))
+		self.heap.append((self.when(record), next(self._counter), record))
+
+	def _remove(self, pred):
+		keep = [entry for entry in self.heap if not pred(entry[2])]
+
+		if len(keep) == len(self.heap):
+			return False
+
+		self.heap = keep
+		self.ids = set(entry[2].get('id') for entry in keep)
+		return True
+
+	def add(self, record):
+		'''Schedule a newly created record.'''
+
+		if self._loading:
+			self._added.append(record)
+
+		# records after the window are picked up when it's loaded again
+		if self.window_end is None or self.when(record) >= self.window_end:
+			return
+
+		if record.get('id') in self.ids:
+			return
+
+		self.ids.add(record.get('id'))
+		heapq.heappush(self.heap, (self.when(record), next(self._counter), record))
+
+		if self.heap[0][2] is record:
+			self._wakeup.set()
+
+	def remove_if(self, pred):
+		'''Unschedule records matching the predicate, for records that were deleted or changed.'''
+
+		if self._loading:
+			self._removed.append(pred)
+
+		if self._remove(pred):
+			heapq.heapify(self.heap)
+			self._wakeup.set()
+
+	def reload(self):
+		'''Load the window again, for when records were changed in ways `add` and `remove_if` can't express.'''
+
+		self.window_end = None
+		self._wakeup.set()
+
+	async def get_records(self, until):
 		raise NotImplementedError
 
-	async def cleanup_record(self, record):
+	async def claim_records(self, now):
+		'''Delete and return every record due at `now`.'''
+
 		raise NotImplementedError
 
 	def when(self, record):
 		raise NotImplementedError
 
-	def maybe_restart(self, dt):
-		if self.record is None:
-			self.restart_task()
+	def shard_predicate(self, start_at=1):
+		'''When running only some shards of a cluster, restricts records to guilds on those shards.
 
-		elif dt < self.when(self.record):
-			self.restart_task()
+		Returns an SQL condition and the arguments it needs, starting at parameter `start_at`.'''
 
-	def restart_if(self, pred):
-		if self.record is None or pred(self.record):
-			self.restart_task()
+		shard_ids = getattr(self.bot, 'shard_ids', None)
+
+		if shard_ids is None:
+			return 'TRUE', tuple()
+
+		return (
+			'(guild_id >> 22) % ${0} = ANY(${1}::int[])'.format(start_at, start_at + 1),
+			(self.bot.shard_count, list(shard_ids))
+		)
 
 
 class ColumnTimer(DatabaseTimer):
@@ -95,14 +225,21 @@ class ColumnTimer(DatabaseTimer):
 		self.table = table
 		self.column = column
 
-	async def get_record(self):
-		return await self.bot.db.fetchrow(
-			'SELECT * FROM {0} WHERE {1} < $1 AND {1} IS NOT NULL ORDER BY {1} LIMIT 1'.format(self.table, self.column),
-			datetime.utcnow() + self.MAX_SLEEP
+	async def get_records(self, until):
+		shard_sql, shard_args = self.shard_predicate(start_at=2)
+
+		return await self.bot.db.fetch(
+			'SELECT * FROM {0} WHERE {1} < $1 AND {1} IS NOT NULL AND {2}'.format(self.table, self.column, shard_sql),
+			until, *shard_args
 		)
 
-	async def cleanup_record(self, record):
-		await self.bot.db.execute('DELETE FROM {0} WHERE id=$1'.format(self.table), record.get('id'))
+	async def claim_records(self, now):
+		shard_sql, shard_args = self.shard_predicate(start_at=2)
+
+		return await self.bot.db.fetch(
+			'DELETE FROM {0} WHERE {1} <= $1 AND {2} RETURNING *'.format(self.table, self.column, shard_sql),
+			now, *shard_args
+		)
 
 	def when(self, record):
 		return record.get(self.column)
@@ -0,0 +1,199 @@
+from bisect import bisect_left
+
+
+class Histogram:
+	'''Fixed-bucket histogram. Memory use is constant no matter how many values are observed.'''
+
+	# seconds, from 1ms to 10s
+	DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+
+		# one count per bucket, plus one for values above the last bucket
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def percentile(self, p):
+		'''Estimate the p-th percentile, interpolating linearly inside the bucket it falls in.'''
+
+		if not self.count:
+			return None
+
+		target = self.count * p / 100
+		seen = 0
+
+		for idx, count in enumerate(self.counts):
+			if seen + count >= target and count:
+				# values above the last bucket can't be interpolated, clamp to its bound
+				if idx == len(self.buckets):
+					return self.buckets[-1]
+
+				lower = self.buckets[idx - 1] if idx else 0.0
+				upper = self.buckets[idx]
+
+				return lower + (upper - lower) * (target - seen) / count
+
+			seen += count
+
+		return self.buckets[-1]
+
+	@property
+	def mean(self):
+		return self.sum / self.count if self.count else None
+
+
+class Value:
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0.0
+
+	def inc(self, amount=1.0):
+		self.value += amount
+
+	def set(self, value):
+		self.value = value
+
+
+class Metric:
+	'''A named metric with zero or more labels. Each set of label values gets its own child.
+
+	If `callback` is given it's called at scrape time and should return a dict mapping tuples
+	of label values to a number (or a Histogram, for histogram metrics).
+	'''
+
+	KINDS = ('counter', 'gauge', 'histogram')
+
+	def __init__(self, kind, name, documentation, labels=(), callback=None, buckets=Histogram.DEFAULT_BUCKETS):
+		if kind not in self.KINDS:
+			raise ValueError('Unknown metric kind \'{}\''.format(kind))
+
+		self.kind = kind
+		self.name = name
+		self.documentation = documentation
+		self.label_names = tuple(labels)
+		self.callback = callback
+		self.buckets = buckets
+
+		self.children = dict()
+
+	def labels(self, *values):
+		if len(values) != len(self.label_names):
+			raise ValueError('Metric {} expects labels {}'.format(self.name, self.label_names))
+
+		child = self.children.get(values, None)
+
+		if child is None:
+			child = Histogram(self.buckets) if self.kind == 'histogram' else Value()
+			self.children[values] = child
+
+		return child
+
+	def inc(self, amount=1.0):
+		self.labels().inc(amount)
+
+	def set(self, value):
+		self.labels().set(value)
+
+	def observe(self, value):
+		self.labels().observe(value)
+
+	def render(self):
+		lines = [
+			'# HELP {} {}'.format(self.name, self.documentation),
+			'# TYPE {} {}'.format(self.name, self.kind),
+		]
+
+		if self.callback is not None:
+			children = self.callback()
+		else:
+			children = self.children
+
+		for values, child in sorted(children.items()):
+			labels = list(zip(self.label_names, values))
+
+			if self.kind == 'histogram':
+				lines.extend(render_histogram(self.name, labels, child))
+			else:
+				lines.append(render_sample(self.name, labels, child.value if isinstance(child, Value) else child))
+
+		return lines
+
+
+class MetricsRegistry:
+	'''Collection of metrics that renders them in the Prometheus text format.'''
+
+	def __init__(self, prefix='ace_'):
+		self.prefix = prefix
+		self.metrics = dict()
+
+	def add(self, kind, name, documentation, labels=(), **kwargs):
+		name = self.prefix + name
+
+		if name in self.metrics:
+			raise ValueError('Metric {} already registered'.format(name))
+
+		metric = Metric(kind, name, documentation, labels, **kwargs)
+		self.metrics[name] = metric
+
+		return metric
+
+	def counter(self, name, documentation, labels=(), **kwargs):
+		return self.add('counter', name, documentation, labels, **kwargs)
+
+	def gauge(self, name, documentation, labels=(), **kwargs):
+		return self.add('gauge', name, documentation, labels, **kwargs)
+
+	def histogram(self, name, documentation, labels=(), **kwargs):
+		return self.add('histogram', name, documentation, labels, **kwargs)
+
+	def render(self):
+		lines = list()
+
+		for metric in self.metrics.values():
+			lines.extend(metric.render())
+
+		return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_sample(name, labels, value):
+	if labels:
+		name += '{' + ','.join('{}="{}"'.format(key, escape_label(val)) for key, val in labels) + '}'
+
+	return '{} {}'.format(name, format_value(value))
+
+
+def render_histogram(name, labels, histogram):
+	lines = list()
+	cumulative = 0
+
+	for bound, count in zip(histogram.buckets, histogram.counts):
+		cumulative += count
+		lines.append(render_sample(name + '_bucket', labels + [('le', format_value(bound))], cumulative))
+
+	lines.append(render_sample(name + '_bucket', labels + [('le', '+Inf')], histogram.count))
+	lines.append(render_sample(name + '_sum', labels, histogram.sum))
+	lines.append(render_sample(name + '_count', labels, histogram.count))
+
+	return lines
+
+
+def format_value(value):
+	if isinstance(value, bool):
+		return '1' if value else '0'
+
+	if isinstance(value, int):
+		return str(value)
+
+	return repr(float(value))
@@ -0,0 +1,136 @@
+import logging
+
+import asyncpg
+import asyncpg.pool
+from asyncpg.prepared_stmt import PreparedStatement
+
+
+log = logging.getLogger(__name__)
+
+
+class Query:
+	'''A named statement in the catalog. Run it with one of the call helpers, passing the pool or a connection.'''
+
+	__slots__ = ('name', 'sql')
+
+	def __init__(self, name, sql):
+		self.name = name
+		self.sql = sql
+
+	def __repr__(self):
+		return '<Query name={0}>'.format(self.name)
+
+	async def fetch(self, executor, *args):
+		return await run(executor, self, 'fetch', args)
+
+	async def fetchrow(self, executor, *args):
+		return await run(executor, self, 'fetchrow', args)
+
+	async def fetchval(self, executor, *args):
+		return await run(executor, self, 'fetchval', args)
+
+	async def execute(self, executor, *args):
+		'''Run the statement and return the status message, like `Connection.execute`.'''
+
+		return await run(executor, self, 'execute', args)
+
+
+class QueryCatalog:
+	'''Named statements that run as prepared statements on every pool connection.
+
+	Cogs register their statements at import time. The pool is created with `init_connection`
+	as its init hook and `CatalogConnection` as its connection class, so every new connection
+	prepares all registered statements up front. Extensions are loaded after the pool is created,
+	so the bot expires the pool connections once they're loaded. Statements registered after a
+	connection was opened are prepared on that connection the first time they run on it.
+
+	Reloading an extension registers its statements again. If one of them changed, it replaces
+	the old one, and connections prepare the new statement the next time it runs.
+	'''
+
+	def __init__(self):
+		self.queries = dict()
+
+	def __iter__(self):
+		return iter(self.queries.values())
+
+	def __len__(self):
+		return len(self.queries)
+
+	def register(self, name, sql):
+		'''Register a statement under a unique name. Registering the same statement again is a no-op.'''
+
+		query = self.queries.get(name, None)
+
+		if query is not None and query.sql == sql:
+			return query
+
+		if query is not None:
+			log.info('Replacing statement %s', name)
+
+		query = self.queries[name] = Query(name, sql)
+		return query
+
+	async def init_connection(self, con):
+		for query in list(self.queries.values()):
+			try:
+				await con.get_prepared(query)
+			except asyncpg.PostgresError as exc:
+				# don't fail the connection, the query will raise properly when it's actually used
+				log.warning('Failed preparing %s: %s', query.name, str(exc))
+
+
+class CatalogConnection(asyncpg.Connection):
+	'''Connection that holds on to the prepared statements of the catalog, with the SQL they were prepared from.'''
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._prepared = dict()
+
+	async def get_prepared(self, query):
+		sql, stmt = self._prepared.get(query.name, (None, None))
+
+		# the statement was replaced since it was prepared here
+		if sql != query.sql:
+			stmt = None
+
+		if stmt is None:
+			stmt = await self.prepare(query.sql)
+			self._prepared[query.name] = (query.sql, stmt)
+		elif stmt._con_release_ctr != self._pool_release_ctr:
+			# a statement object is only valid until the connection goes back to the pool, the server
+			# side statement outlives that, so wrap it again instead of preparing it over
+			stmt = PreparedStatement(self, query.sql, stmt._state)
+			self._prepared[query.name] = (query.sql, stmt)
+
+		return stmt
+
+	def forget_prepared(self, query):
+		self._prepared.pop(query.name, None)
+
+
+catalog = QueryCatalog()
+register = catalog.register
+
+
+async def run(executor, query, method, args):
+	if isinstance(executor, asyncpg.pool.Pool):
+		async with executor.acquire() as con:
+			return await run(con, query, method, args)
+
+	try:
+		return await _run_prepared(executor, query, method, args)
+	except (asyncpg.InvalidCachedStatementError, asyncpg.OutdatedSchemaCacheError):
+		# the schema changed under the prepared statement, prepare it again and retry once
+		executor.forget_prepared(query)
+		return await _run_prepared(executor, query, method, args)
+
+
+async def _run_prepared(con, query, method, args):
+	stmt = await con.get_prepared(query)
+
+	if method == 'execute':
+		await stmt.fetch(*args)
+		return stmt.get_statusmsg()
+
+	return await getattr(stmt, method)(*args)
@@ -0,0 +1,152 @@
+import logging
+import re
+from time import perf_counter
+
+import asyncpg
+import asyncpg.pool
+import asyncpg.prepared_stmt
+
+from utils.metrics import Histogram
+
+
+log = logging.getLogger(__name__)
+
+WHITESPACE_RE = re.compile(r'\s+')
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<!\$)\b\d+\b")
+
+# stop remembering new query -> template mappings past this size
+MAX_CACHED_TEMPLATES = 4096
+
+
+def normalize(query):
+	'''Turn a query into its template by collapsing whitespace and replacing literals.'''
+
+	return LITERAL_RE.sub('?', WHITESPACE_RE.sub(' ', query).strip())
+
+
+class QueryTemplateStats:
+	__slots__ = ('template', 'calls', 'errors', 'rows', 'latency')
+
+	def __init__(self, template):
+		self.template = template
+		self.calls = 0
+		self.errors = 0
+		self.rows = 0
+		self.latency = Histogram()
+
+	@property
+	def total_time(self):
+		return self.latency.sum
+
+
+class QueryStats:
+	'''Per-query-template latency stats, collected by wrapping asyncpg internals.
+
+	Covers queries run with arguments (fetch/fetchrow/fetchval/execute with args) and
+	prepared statements from the query catalog, which is how every query in the bot is
+	run. Also measures how long acquiring a pool connection takes.
+	'''
+
+	def __init__(self, slow_threshold=0.5):
+		self.slow_threshold = slow_threshold
+
+		self.templates = dict()
+		self.pool_wait = Histogram()
+		self.slow_queries = 0
+
+		self._template_cache = dict()
+
+	def get_template(self, query):
+		template = self._template_cache.get(query, None)
+
+		if template is None:
+			template = normalize(query)
+
+			if len(self._template_cache) < MAX_CACHED_TEMPLATES:
+				self._template_cache[query] = template
+
+		return template
+
+	def record(self, query, elapsed, rows, failed=False):
+		template = self.get_template(query)
+
+		stats = self.templates.get(template, None)
+		if stats is None:
+			stats = self.templates[template] = QueryTemplateStats(template)
+
+		stats.calls += 1
+		stats.rows += rows
+		stats.latency.observe(elapsed)
+
+		if failed:
+			stats.errors += 1
+
+		if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+			self.slow_queries += 1
+			log.warning('Slow query (%.0fms, %s rows): %s', elapsed * 1000, rows, template)
+		else:
+			log.debug('Query (%.2fms): %s', elapsed * 1000, template)
+
+	def top(self, n=10):
+		'''Query templates with the highest total time spent.'''
+
+		return sorted(self.templates.values(), key=lambda stats: stats.total_time, reverse=True)[:n]
+
+	def install(self):
+		'''Wrap asyncpg to feed this instance. Should only be done once per process.'''
+
+		stats = self
+		old_execute = asyncpg.Connection._execute
+		old_acquire = asyncpg.pool.Pool._acquire
+		old_bind_execute = asyncpg.prepared_stmt.PreparedStatement._PreparedStatement__bind_execute
+
+		async def _execute(self, query, args, limit, timeout, return_status=False):
+			start = perf_counter()
+
+			try:
+				result = await old_execute(self, query, args, limit, timeout, return_status)
+			except Exception:
+				stats.record(query, perf_counter() - start, 0, failed=True)
+				raise
+
+			stats.record(query, perf_counter() - start, count_rows(result, return_status))
+
+			return result
+
+		async def _bind_execute(self, args, limit, timeout):
+			start = perf_counter()
+
+			try:
+				result = await old_bind_execute(self, args, limit, timeout)
+			except Exception:
+				stats.record(self._query, perf_counter() - start, 0, failed=True)
+				raise
+
+			stats.record(self._query, perf_counter() - start, len(result) if result else 0)
+
+			return result
+
+		async def _acquire(self, timeout):
+			start = perf_counter()
+
+			try:
+				return await old_acquire(self, timeout)
+			finally:
+				stats.pool_wait.observe(perf_counter() - start)
+
+		asyncpg.Connection._execute = _execute
+		asyncpg.pool.Pool._acquire = _acquire
+		asyncpg.prepared_stmt.PreparedStatement._PreparedStatement__bind_execute = _bind_execute
+
+
+def count_rows(result, return_status):
+	if return_status:
+		# (records, status, completed) where status is like b'UPDATE 3'
+		status = result[1]
+		if isinstance(status, bytes):
+			status = status.decode()
+
+		count = status.rpartition(' ')[2] if status else ''
+		return int(count) if count.isdigit() else len(result[0] or ())
+
+	return len(result) if result else 0
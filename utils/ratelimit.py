@@ -0,0 +1,249 @@
+from hashlib import blake2b
+from time import monotonic
+
+
+class Bucket:
+	__slots__ = ('tokens', 'updated')
+
+	def __init__(self, tokens, updated):
+		self.tokens = tokens
+		self.updated = updated
+
+
+class RateLimiter:
+	'''Token buckets allowing `rate` tokens per `per` seconds for each key.
+
+	A bucket starts full with `rate` tokens and refills continuously. Updates never await, so
+	nothing needs a lock around them. Full buckets are the same as no bucket, so `sweep` drops
+	them to keep the map down to members that are actually sending things.
+	'''
+
+	def __init__(self, rate, per):
+		self.rate = rate
+		self.per = per
+		self.refill = rate / per
+
+		self.buckets = dict()
+
+	def __len__(self):
+		return len(self.buckets)
+
+	def hit(self, key, cost=1, now=None):
+		'''Take `cost` tokens from a bucket. Returns seconds until enough tokens are available if rate limited, otherwise None.'''
+
+		if now is None:
+			now = monotonic()
+
+		bucket = self.buckets.get(key, None)
+
+		if bucket is None:
+			bucket = self.buckets[key] = Bucket(self.rate, now)
+			tokens = self.rate
+		else:
+			tokens = min(self.rate, bucket.tokens + (now - bucket.updated) * self.refill)
+
+		bucket.updated = now
+
+		if tokens < cost:
+			bucket.tokens = tokens
+			return (cost - tokens) / self.refill
+
+		bucket.tokens = tokens - cost
+		return None
+
+	def reset(self, key):
+		self.buckets.pop(key, None)
+
+	def sweep(self, now=None):
+		'''Drop buckets that have refilled. Returns how many were dropped.'''
+
+		if now is None:
+			now = monotonic()
+
+		full = [
+			key for key, bucket in self.buckets.items()
+			if bucket.tokens + (now - bucket.updated) * self.refill >= self.rate
+		]
+
+		for key in full:
+			del self.buckets[key]
+
+		return len(full)
+
+
+class Duplicate:
+	__slots__ = ('tokens', 'updated', 'channel_id', 'tick')
+
+	def __init__(self, tokens, updated, channel_id, tick):
+		self.tokens = tokens
+		self.updated = updated
+		self.channel_id = channel_id
+		self.tick = tick
+
+
+class DuplicateDetector:
+	'''Rate limits members posting the same message over and over.
+
+	Works like RateLimiter, with one bucket per member and message content. The content is only
+	kept as a 64 bit fingerprint. Posting it in another channel than last time costs `penalty`
+	extra tokens.
+
+	Buckets are expired with a time wheel of `per` seconds split into `slots` ticks. Each bucket
+	sits in the slot of the tick it was last hit in, and a slot is emptied when the wheel comes
+	back around to it, by which time its buckets are full again. No more than `max_entries`
+	buckets are kept; past that the least recently hit ones are dropped early.
+	'''
+
+	def __init__(self, rate, per, penalty=0, max_entries=10000, slots=8):
+		self.rate = rate
+		self.per = per
+		self.refill = rate / per
+		self.penalty = penalty
+		self.max_entries = max_entries
+
+		self.tick_length = per / slots
+		self.tick = None
+
+		# one more slot than ticks per period, so the slot emptied on a tick never holds buckets from the last one
+		self.wheel = [set() for _ in range(slots + 1)]
+		self.entries = dict()
+
+		self.expired = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	@staticmethod
+	def fingerprint(author_id, content):
+		digest = blake2b(content.encode(), digest_size=8, key=author_id.to_bytes(8, 'little'))
+		return int.from_bytes(digest.digest(), 'little')
+
+	def _advance(self, now):
+		tick = int(now / self.tick_length)
+
+		if self.tick is None:
+			self.tick = tick
+			return
+
+		# going around more than once empties the same slots again
+		for step in range(min(tick - self.tick, len(self.wheel))):
+			slot = self.wheel[(self.tick + step + 1) % len(self.wheel)]
+
+			for key in slot:
+				del self.entries[key]
+
+			self.expired += len(slot)
+			slot.clear()
+
+		self.tick = max(self.tick, tick)
+
+	def expire(self, now=None):
+		'''Drop buckets that are full again, without counting a message.'''
+
+		self._advance(monotonic() if now is None else now)
+
+	def _evict(self):
+		# oldest slot first, which is the one after the current tick
+		for step in range(1, len(self.wheel) + 1):
+			slot = self.wheel[(self.tick + step) % len(self.wheel)]
+
+			if slot:
+				del self.entries[slot.pop()]
+				self.evictions += 1
+				return
+
+	def hit(self, key, channel_id, now=None):
+		'''Count a message with the given fingerprint. Returns seconds until it's allowed again if rate limited, otherwise None.'''
+
+		if now is None:
+			now = monotonic()
+
+		self._advance(now)
+
+		entry = self.entries.get(key, None)
+
+		if entry is None:
+			if len(self.entries) >= self.max_entries:
+				self._evict()
+
+			entry = self.entries[key] = Duplicate(self.rate, now, channel_id, self.tick)
+			self.wheel[self.tick % len(self.wheel)].add(key)
+
+			tokens = self.rate
+			cost = 1
+		else:
+			if entry.tick != self.tick:
+				self.wheel[entry.tick % len(self.wheel)].discard(key)
+				self.wheel[self.tick % len(self.wheel)].add(key)
+				entry.tick = self.tick
+
+			tokens = min(self.rate, entry.tokens + (now - entry.updated) * self.refill)
+			cost = 1 if entry.channel_id == channel_id else 1 + self.penalty
+
+		entry.updated = now
+		entry.channel_id = channel_id
+
+		if tokens < cost:
+			entry.tokens = tokens
+			return (cost - tokens) / self.refill
+
+		entry.tokens = tokens - cost
+		return None
+
+	def reset(self, key):
+		entry = self.entries.pop(key, None)
+
+		if entry is not None:
+			self.wheel[entry.tick % len(self.wheel)].discard(key)
+
+	@property
+	def stats(self):
+		return dict(
+			entries=len(self.entries), max_entries=self.max_entries, expired=self.expired, evictions=self.evictions
+		)
+
+
+class SlidingWindowCounter:
+	'''Estimates how many events happened in the last `per` seconds.
+
+	Counts events in fixed windows of `per` seconds and weighs the count of the previous window
+	by how much of it still overlaps the sliding window, assuming its events were evenly spread.
+	That keeps it at two counters no matter how many events there are.
+	'''
+
+	def __init__(self, per):
+		self.per = per
+
+		self.window = None
+		self.current = 0
+		self.previous = 0
+
+	def _roll(self, now):
+		window = int(now // self.per)
+
+		if window == self.window:
+			return
+
+		self.previous = self.current if self.window is not None and window == self.window + 1 else 0
+		self.current = 0
+		self.window = window
+
+	def count(self, now=None):
+		if now is None:
+			now = monotonic()
+
+		self._roll(now)
+
+		return self.previous * (1.0 - (now % self.per) / self.per) + self.current
+
+	def add(self, now=None):
+		'''Count an event. Returns the new estimate.'''
+
+		if now is None:
+			now = monotonic()
+
+		self._roll(now)
+		self.current += 1
+
+		return self.count(now)